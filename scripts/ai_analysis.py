@@ -1,12 +1,76 @@
 __author__ = "Vitali Quiering"
-__version__ = "1.2.0"
+__version__ = "1.9.0"
 
 import requests
+from requests.adapters import HTTPAdapter
 from seatable_api import Base, context
+from seatable_api.constants import ColumnTypes
 from io import StringIO
+import atexit
 import csv
+import datetime
+import email.utils
+import hashlib
+import json
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
 
 config_table = "_settings"
+chatgpt_model = "gpt-4"
+openai_timeout = 120
+openai_max_retries = 5
+openai_retry_status_codes = (429, 500, 502, 503, 504)
+
+# opt-in completion cache, enabled by the openai_cache_file setting
+openai_cache_file = None
+openai_cache_ttl = 24 * 60 * 60
+openai_cache_max_entries = 1000
+
+# views larger than chatgpt_chunk_tokens (prompt and rows) are analysed in chunks, which are combined
+# in a final pass. the default leaves room for the answer within the 8k context of gpt-4
+chatgpt_chunk_tokens = 5000
+chatgpt_concurrency = 4
+chatgpt_reduce_prompt = (
+    "The following texts are analyses of consecutive parts of the same data. "
+    "Combine them into a single analysis, as if the data had been analysed as a whole."
+)
+
+# metrics of every OpenAI API call, written to the telemetry_file (JSON lines) and telemetry_table settings
+telemetry_file = None
+telemetry_table = None
+telemetry_columns = {
+    "Time": ColumnTypes.TEXT,
+    "Service": ColumnTypes.TEXT,
+    "Endpoint": ColumnTypes.TEXT,
+    "Model": ColumnTypes.TEXT,
+    "Status": ColumnTypes.TEXT,
+    "Latency ms": ColumnTypes.NUMBER,
+    "TTFB ms": ColumnTypes.NUMBER,
+    "Request bytes": ColumnTypes.NUMBER,
+    "Response bytes": ColumnTypes.NUMBER,
+    "Prompt tokens": ColumnTypes.NUMBER,
+    "Completion tokens": ColumnTypes.NUMBER,
+}
+telemetry_rows = []
+telemetry_lock = threading.Lock()
+
+# pooled keep-alive connections to the OpenAI API
+openai_session = requests.Session()
+openai_session.mount("https://", HTTPAdapter(pool_maxsize=16))
+
 server_url = context.server_url
 api_token = context.api_token
 
@@ -14,7 +78,25 @@ base = Base(api_token, server_url)
 base.auth()
 
 table_name = "Auswertung"
-gpt_rows = base.list_rows(table_name, view_name="Stats AI")
+analysis_view = "Stats AI"
+# columns sent to the model, comma separated in the analysis_columns setting (default: all columns of the view)
+analysis_columns = None
+# optional SQL condition, e.g. "Year = 2023". rows are then read with base.query, which ignores the view
+analysis_filter = None
+rows_page_size = 1000
+
+analysis_table = "AI Analysis"
+# analysis_mode "incremental" only sends the rows changed since the previous analysis, which is
+# stored with the _mtime watermark of the analysed rows in the Watermark column of analysis_table
+watermark_column = "Watermark"
+
+# analysis_mode "summary" sends statistics computed with pandas and a sample instead of all rows
+analysis_mode = "rows"
+analysis_group_by = None
+analysis_sample_rows = 20
+analysis_outliers = 5
+analysis_top_values = 10
+analysis_top_groups = 50
 
 def get_config_values(config_table):
     rows = base.list_rows(config_table)
@@ -30,19 +112,173 @@ def check_config_table(config_table):
     if not config_table_found:
         raise SystemExit("Config table not found!")
 
-def call_chatgpt(openai_api_key, chatgpt_prompt, rows):
-    url = "https://api.openai.com/v1/chat/completions"
+def check_telemetry_table(telemetry_table):
+    base_metadata = base.get_metadata()
+    if any(table["name"] == telemetry_table for table in base_metadata["tables"]):
+        return
+    base.add_table(telemetry_table)
+    for column, column_type in telemetry_columns.items():
+        base.insert_column(telemetry_table, column, column_type)
+
+def record_api_call(service, endpoint, model, started_at, response=None, error=None):
+    if not telemetry_file and not telemetry_table:
+        return
+    usage = {}
+    if response is not None:
+        try:
+            usage = response.json().get("usage") or {}
+        except (ValueError, AttributeError):
+            pass
+    metrics = {
+        "Time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "Service": service,
+        "Endpoint": endpoint,
+        "Model": model,
+        "Status": str(response.status_code) if response is not None else type(error).__name__,
+        "Latency ms": round((time.monotonic() - started_at) * 1000),
+        # requests measures the time until the response headers arrived
+        "TTFB ms": round(response.elapsed.total_seconds() * 1000) if response is not None else None,
+        "Request bytes": len(response.request.body or b"") if response is not None else None,
+        "Response bytes": len(response.content) if response is not None else None,
+        "Prompt tokens": usage.get("prompt_tokens"),
+        "Completion tokens": usage.get("completion_tokens"),
+    }
+    with telemetry_lock:
+        if telemetry_file:
+            with open(telemetry_file, "a") as f:
+                f.write(json.dumps(metrics) + "\n")
+        # written to the table by flush_telemetry when the script ends
+        if telemetry_table:
+            telemetry_rows.append(metrics)
+
+def flush_telemetry():
+    with telemetry_lock:
+        rows = telemetry_rows[:]
+        del telemetry_rows[:]
+    if not rows:
+        return
+    check_telemetry_table(telemetry_table)
+    for i in range(0, len(rows), 1000):
+        base.batch_append_rows(telemetry_table, rows[i:i + 1000])
+
+def parse_retry_after(response):
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+def openai_request(openai_api_key, path, data):
+    # retries 429/5xx, connection errors and timeouts with exponential backoff, honoring Retry-After
+    url = f"https://api.openai.com/v1/{path}"
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {openai_api_key}"
     }
+    max_retries = int(openai_max_retries)
+    for attempt in range(max_retries + 1):
+        retry_after = None
+        started_at = time.monotonic()
+        try:
+            response = openai_session.post(url, headers=headers, json=data, timeout=float(openai_timeout))
+            record_api_call("openai", path, data.get("model"), started_at, response)
+            if response.status_code not in openai_retry_status_codes or attempt == max_retries:
+                response.raise_for_status()
+                return response.json()
+            retry_after = parse_retry_after(response)
+            error = f"status code {response.status_code}"
+        except (requests.ConnectionError, requests.Timeout) as e:
+            record_api_call("openai", path, data.get("model"), started_at, error=e)
+            if attempt == max_retries:
+                raise
+            error = e
+        delay = retry_after if retry_after is not None else 2 ** attempt + random.random()
+        print(f"OpenAI request failed ({error}), retrying in {delay:.1f}s...")
+        time.sleep(delay)
+
+def open_openai_cache():
+    if not openai_cache_file:
+        return None
+    connection = sqlite3.connect(openai_cache_file)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS completions "
+        "(key TEXT PRIMARY KEY, response TEXT, created_at REAL, used_at REAL)"
+    )
+    connection.commit()
+    return connection
+
+def get_cached_response(key, now):
+    openai_cache = open_openai_cache()
+    try:
+        found = openai_cache.execute(
+            "SELECT response FROM completions WHERE key = ? AND created_at > ?",
+            (key, now - float(openai_cache_ttl)),
+        ).fetchone()
+        if not found:
+            return None
+        openai_cache.execute("UPDATE completions SET used_at = ? WHERE key = ?", (now, key))
+        openai_cache.commit()
+    finally:
+        openai_cache.close()
+    return json.loads(found[0])
+
+def add_cached_response(key, response_json, now):
+    openai_cache = open_openai_cache()
+    try:
+        openai_cache.execute(
+            "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+            (key, json.dumps(response_json), now, now),
+        )
+        # evict expired responses, then the least recently used ones
+        openai_cache.execute("DELETE FROM completions WHERE created_at <= ?", (now - float(openai_cache_ttl),))
+        openai_cache.execute(
+            "DELETE FROM completions WHERE key NOT IN "
+            "(SELECT key FROM completions ORDER BY used_at DESC LIMIT ?)",
+            (int(openai_cache_max_entries),),
+        )
+        openai_cache.commit()
+    finally:
+        openai_cache.close()
+
+def cached_openai_request(openai_api_key, path, data):
+    # key is a hash of endpoint, model, messages and sampling parameters
+    if not openai_cache_file:
+        return openai_request(openai_api_key, path, data)
+
+    key = hashlib.sha256(json.dumps({"path": path, "data": data}, sort_keys=True).encode()).hexdigest()
+    now = time.time()
+    # the cache is optional, if it fails (e.g. locked by another worker) the request is sent without it
+    try:
+        response_json = get_cached_response(key, now)
+    except sqlite3.Error as e:
+        print(f"Failed to read the OpenAI cache, sending the request: {e}")
+        response_json = None
+    if response_json is not None:
+        print("Using the cached OpenAI response")
+        return response_json
+
+    response_json = openai_request(openai_api_key, path, data)
+    try:
+        add_cached_response(key, response_json, now)
+    except sqlite3.Error as e:
+        print(f"Failed to write the OpenAI cache: {e}")
+    return response_json
+
+def call_chatgpt(openai_api_key, chatgpt_prompt, rows):
     data = {
         "messages": [
             {"role": "system", "content": f"{chatgpt_prompt}"},
             {"role": "assistant", "content": "Ok"},
             {"role": "user", "content": f"{rows}"}
         ],
-        "model": "gpt-4",
+        "model": chatgpt_model,
         "temperature": 0.3
     }
 
@@ -50,34 +286,237 @@ def call_chatgpt(openai_api_key, chatgpt_prompt, rows):
     # print(rows)
 
     try:
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        generated_text = response.json()["choices"][0]["message"]["content"]
-    except (requests.HTTPError, KeyError) as e:
+        response_json = cached_openai_request(openai_api_key, "chat/completions", data)
+        generated_text = response_json["choices"][0]["message"]["content"]
+    except (requests.RequestException, KeyError) as e:
         print(f"Error was caught: {e}")
         return None
     return generated_text
 
-def convert_to_csv(gpt_rows):
-    if not gpt_rows:
-        return ""
-    
-    headers = gpt_rows[0].keys()
+def get_analysis_columns():
+    if analysis_columns:
+        return [column.strip() for column in analysis_columns.split(",") if column.strip()]
+    return [column["name"] for column in base.list_columns(table_name, view_name=analysis_view)]
+
+def iter_rows(columns, modified_after=None):
+    # pages through the rows, keeping only the given columns
+    start = 0
+    while True:
+        if analysis_filter:
+            column_list = ", ".join(f"`{column}`" for column in columns)
+            condition = f"({analysis_filter})"
+            if modified_after:
+                condition += f" AND `_mtime` > '{modified_after}'"
+            rows = base.query(
+                f"SELECT {column_list}, `_mtime` FROM `{table_name}` WHERE {condition} "
+                f"ORDER BY `_id` LIMIT {rows_page_size} OFFSET {start}"
+            )
+        else:
+            rows = base.list_rows(table_name, view_name=analysis_view, start=start, limit=rows_page_size)
+        for row in rows:
+            if modified_after and row.get("_mtime", "") <= modified_after:
+                continue
+            yield {column: row.get(column, "") for column in columns}
+        if len(rows) < rows_page_size:
+            break
+        start += len(rows)
+
+def iter_csv_lines(columns, rows):
+    # yields the header line, then one line per row
     output = StringIO()
-    writer = csv.DictWriter(output, fieldnames=headers)
-    writer.writeheader()
-    writer.writerows(gpt_rows)
-    
-    return output.getvalue()
+    writer = csv.writer(output)
+    writer.writerow(columns)
+    for row in rows:
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+        writer.writerow([row[column] for column in columns])
+    yield output.getvalue()
+
+def summarize_rows(columns, rows):
+    df = pd.DataFrame.from_records(rows, columns=columns)
+    # multiple select and link values come as lists, empty cells as ""
+    df = df.apply(lambda column: column.map(lambda value: ", ".join(map(str, value)) if isinstance(value, list) else value))
+    df = df.where(df != "")
+
+    numeric = df.apply(pd.to_numeric, errors="coerce")
+    numeric_columns = [
+        column for column in columns
+        if df[column].notna().any() and numeric[column].notna().sum() == df[column].notna().sum()
+    ]
+    numeric = numeric[numeric_columns]
+
+    sections = [f"Number of rows: {len(df)}"]
+    if numeric_columns:
+        statistics = numeric.describe(percentiles=[0.05, 0.25, 0.5, 0.75, 0.95]).T
+        statistics["sum"] = numeric.sum()
+        sections.append("Statistics of the numeric columns:\n" + statistics.to_csv())
+
+    for column in columns:
+        if column in numeric_columns:
+            continue
+        values = df[column].dropna().astype(str)
+        counts = values.value_counts().head(int(analysis_top_values))
+        sections.append(
+            f"Most frequent values of {column} ({values.nunique()} distinct):\n" + counts.to_csv(header=False)
+        )
+
+    group_columns = [column.strip() for column in (analysis_group_by or "").split(",") if column.strip()]
+    for column in group_columns:
+        if column not in df or not numeric_columns:
+            continue
+        keys = df[column].fillna("").astype(str)
+        grouped = numeric.groupby(keys).agg(["count", "sum", "mean"])
+        largest_groups = keys.value_counts().index[:int(analysis_top_groups)]
+        sections.append(f"Numeric columns grouped by {column}:\n" + grouped.loc[largest_groups].to_csv())
+
+    if numeric_columns and len(df):
+        deviations = ((numeric - numeric.mean()) / numeric.std(ddof=0)).abs()
+        for column in numeric_columns:
+            outliers = deviations[column].nlargest(int(analysis_outliers)).index
+            sections.append(
+                f"Rows with the largest deviation from the mean of {column}:\n" + df.loc[outliers].to_csv(index=False)
+            )
+
+    sample = df.sample(n=min(int(analysis_sample_rows), len(df)), random_state=0)
+    sections.append("Random sample of the rows:\n" + sample.to_csv(index=False))
+    return "\n".join(sections)
 
-def main(openai_api_key, chatgpt_prompt, csv_data):
-    generated_text = call_chatgpt(openai_api_key, chatgpt_prompt, csv_data)
+def count_tokens(text):
+    # roughly 4 characters per token without tiktoken
+    if tiktoken:
+        return len(tiktoken.encoding_for_model(chatgpt_model).encode(text))
+    return len(text) // 4 + 1
+
+def iter_csv_chunks(csv_lines, max_tokens, prompt):
+    # each chunk is sent as its own csv with the prompt, so both count against every chunk
+    header = next(csv_lines)
+    budget = max_tokens - count_tokens(prompt) - count_tokens(header)
+    chunk = []
+    chunk_tokens = 0
+    for line in csv_lines:
+        line_tokens = count_tokens(line)
+        if chunk and chunk_tokens + line_tokens > budget:
+            yield header + "".join(chunk)
+            chunk = []
+            chunk_tokens = 0
+        chunk.append(line)
+        chunk_tokens += line_tokens
+    yield header + "".join(chunk)
+
+def reduce_analyses(openai_api_key, chatgpt_prompt, analyses):
+    reduce_prompt = f"{chatgpt_reduce_prompt}\n\nThe task of the analyses was:\n{chatgpt_prompt}"
+    # the prompt is sent with every group, so it counts against each of them
+    max_tokens = int(chatgpt_chunk_tokens) - count_tokens(reduce_prompt)
+    # combine groups of analyses that fit into one request until a single analysis is left
+    while len(analyses) > 1:
+        groups = [[]]
+        group_tokens = 0
+        for analysis in analyses:
+            analysis_tokens = count_tokens(analysis)
+            if groups[-1] and group_tokens + analysis_tokens > max_tokens:
+                groups.append([])
+                group_tokens = 0
+            groups[-1].append(analysis)
+            group_tokens += analysis_tokens
+        if len(groups) == len(analyses):
+            groups = [analyses[i:i + 2] for i in range(0, len(analyses), 2)]
+
+        print(f"Combining {len(analyses)} analyses in {len(groups)} requests")
+        with ThreadPoolExecutor(max_workers=int(chatgpt_concurrency)) as executor:
+            analyses = list(executor.map(
+                lambda group: call_chatgpt(
+                    openai_api_key,
+                    reduce_prompt,
+                    "\n\n".join(f"Analysis of part {i}:\n{analysis}" for i, analysis in enumerate(group, 1)),
+                ),
+                groups,
+            ))
+        if None in analyses:
+            return None
+    return analyses[0]
+
+def analyse_rows(openai_api_key, chatgpt_prompt, columns, rows):
+    chunks = list(iter_csv_chunks(iter_csv_lines(columns, rows), int(chatgpt_chunk_tokens), chatgpt_prompt))
+    if len(chunks) == 1:
+        return call_chatgpt(openai_api_key, chatgpt_prompt, chunks[0])
+
+    # map: analyse the chunks in parallel, reduce: combine their analyses
+    print(f"Analysing the rows in {len(chunks)} chunks")
+    with ThreadPoolExecutor(max_workers=int(chatgpt_concurrency)) as executor:
+        analyses = list(executor.map(
+            lambda numbered_chunk: call_chatgpt(
+                openai_api_key,
+                f"{chatgpt_prompt}\n\nThe data is split into {len(chunks)} parts, this is part {numbered_chunk[0]}.",
+                numbered_chunk[1],
+            ),
+            enumerate(chunks, 1),
+        ))
+    if None in analyses:
+        return None
+    return reduce_analyses(openai_api_key, chatgpt_prompt, analyses)
+
+def check_watermark_column():
+    column_names = [column["name"] for column in base.list_columns(analysis_table)]
+    if watermark_column not in column_names:
+        base.insert_column(analysis_table, watermark_column, ColumnTypes.TEXT)
+
+def get_latest_mtime():
+    rows = base.query(f"SELECT `_mtime` FROM `{table_name}` ORDER BY `_mtime` DESC LIMIT 1")
+    return rows[0]["_mtime"] if rows else None
+
+def get_previous_analysis():
+    rows = base.query(
+        f"SELECT `Analysis`, `{watermark_column}` FROM `{analysis_table}` "
+        f"WHERE `{watermark_column}` IS NOT NULL ORDER BY `{watermark_column}` DESC LIMIT 1"
+    )
+    return rows[0] if rows else None
+
+def analyse_changes(openai_api_key, chatgpt_prompt, columns):
+    # the watermark is read first, so rows changed during the run are sent again next time
+    watermark = get_latest_mtime()
+    previous_analysis = get_previous_analysis()
+    if not previous_analysis or not previous_analysis.get("Analysis"):
+        return analyse_rows(openai_api_key, chatgpt_prompt, columns, iter_rows(columns)), watermark
+
+    changed_rows = list(iter_rows(columns, previous_analysis[watermark_column]))
+    if not changed_rows:
+        print("No rows changed since the previous analysis")
+        return None, None
+
+    print(f"Updating the previous analysis with {len(changed_rows)} changed rows")
+    update_prompt = (
+        f"{chatgpt_prompt}\n\nThis is your previous analysis of the data:\n{previous_analysis['Analysis']}\n\n"
+        "Since then, the following rows were added or changed. Update the previous analysis with them "
+        "and answer with the complete, updated analysis."
+    )
+    return analyse_rows(openai_api_key, update_prompt, columns, changed_rows), watermark
+
+def main(openai_api_key, chatgpt_prompt):
+    columns = get_analysis_columns()
+    watermark = None
+    if analysis_mode == "incremental":
+        check_watermark_column()
+        generated_text, watermark = analyse_changes(openai_api_key, chatgpt_prompt, columns)
+        if not generated_text:
+            return
+    elif analysis_mode == "summary":
+        summary = summarize_rows(columns, iter_rows(columns))
+        summary_prompt = (
+            f"{chatgpt_prompt}\n\nInstead of all rows, you get statistics computed over all rows "
+            "and a random sample of them."
+        )
+        generated_text = call_chatgpt(openai_api_key, summary_prompt, summary)
+    else:
+        generated_text = analyse_rows(openai_api_key, chatgpt_prompt, columns, iter_rows(columns))
 
     row_data = {
         "Analysis": generated_text
     }
+    if watermark:
+        row_data[watermark_column] = watermark
 
-    base.append_row("AI Analysis", row_data)
+    base.append_row(analysis_table, row_data)
 
 if __name__ == "__main__":
     check_config_table(config_table)
@@ -85,6 +524,29 @@ if __name__ == "__main__":
     config_values = get_config_values(config_table)
     openai_api_key = config_values.get('openai_api_key')
     chatgpt_prompt = config_values.get('chatgpt_prompt')
+    openai_timeout = config_values.get('openai_timeout', openai_timeout)
+    openai_max_retries = config_values.get('openai_max_retries', openai_max_retries)
+    openai_cache_file = config_values.get('openai_cache_file')
+    openai_cache_ttl = config_values.get('openai_cache_ttl', openai_cache_ttl)
+    openai_cache_max_entries = config_values.get('openai_cache_max_entries', openai_cache_max_entries)
+    chatgpt_model = config_values.get('chatgpt_model', chatgpt_model)
+    chatgpt_chunk_tokens = config_values.get('chatgpt_chunk_tokens', chatgpt_chunk_tokens)
+    chatgpt_concurrency = config_values.get('chatgpt_concurrency', chatgpt_concurrency)
+    chatgpt_reduce_prompt = config_values.get('chatgpt_reduce_prompt', chatgpt_reduce_prompt)
+    analysis_view = config_values.get('analysis_view', analysis_view)
+    analysis_columns = config_values.get('analysis_columns')
+    analysis_filter = config_values.get('analysis_filter')
+    analysis_mode = config_values.get('analysis_mode', analysis_mode)
+    analysis_group_by = config_values.get('analysis_group_by')
+    analysis_sample_rows = config_values.get('analysis_sample_rows', analysis_sample_rows)
+    analysis_outliers = config_values.get('analysis_outliers', analysis_outliers)
+    analysis_top_values = config_values.get('analysis_top_values', analysis_top_values)
+    analysis_top_groups = config_values.get('analysis_top_groups', analysis_top_groups)
+    telemetry_file = config_values.get('telemetry_file')
+    telemetry_table = config_values.get('telemetry_table')
+    atexit.register(flush_telemetry)
+
+    if analysis_mode == "summary" and pd is None:
+        raise SystemExit("The summary analysis mode requires the pandas package!")
 
-    csv_data = convert_to_csv(gpt_rows)
-    main(openai_api_key, chatgpt_prompt, csv_data)
\ No newline at end of file
+    main(openai_api_key, chatgpt_prompt)
\ No newline at end of file
@@ -1,17 +1,47 @@
 """
 This script is used to configure and interact with Seatable API for ChatGPT.
 It requires the `seatable-api` package to be installed.
+
+Optional settings in the "_settings" table:
+- openai_timeout: the timeout of OpenAI API requests in seconds (default: 120).
+- openai_max_retries: how often throttled or failed OpenAI API requests are retried (default: 5).
+- openai_cache_file: path of a SQLite file that caches the responses of the OpenAI API, so a row whose
+  inputs did not change is not sent again.
+- openai_cache_ttl: the number of seconds a cached response is used (default: 86400).
+- openai_cache_max_entries: the maximum number of cached responses (default: 1000).
+- chatgpt_mode: 'row' to generate the description of the current row (default), 'bulk' to generate the
+  descriptions of all rows of a table that have a role and vision labels but no description yet.
+- chatgpt_bulk_table: the table that is filled in 'bulk' mode (default: the current table).
+- chatgpt_bulk_view: optional view that limits the rows in 'bulk' mode. Do not filter the view on the
+  description column, the rows are paged by offset.
+- chatgpt_concurrency: the number of OpenAI API requests that are sent at the same time in 'bulk' mode
+  (default: 4).
+- telemetry_file: path of a JSON lines file that receives the metrics of every OpenAI API call:
+  latency, time to first byte, request and response bytes, prompt and completion tokens, model and status.
+- telemetry_table: name of a table that receives the same metrics when the script ends. It is created if it
+  does not exist.
 """
 
 __author__ = "Vitali Quiering"
-__version__ = "1.0.1"
+__version__ = "1.4.0"
 
+import atexit
+import datetime
+import email.utils
 import os
+import random
 import requests
 import base64
+import hashlib
 import json
+import sqlite3
+import threading
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from seatable_api import Base, context
+from seatable_api.constants import ColumnTypes
 
 # Configuration variables
 config_table = "_settings"
@@ -20,6 +50,44 @@ chatgpt_vision_labels_column = "Google Vision API Labels"
 chatgpt_additional_notes_column = "ChatGPT Additional Notes"
 chatgpt_output_column = "ChatGPT Generated Description"
 
+# Defaults of the optional settings
+openai_timeout = 120
+openai_max_retries = 5
+openai_cache_file = None
+openai_cache_ttl = 24 * 60 * 60
+openai_cache_max_entries = 1000
+chatgpt_mode = "row"
+chatgpt_bulk_view = None
+chatgpt_concurrency = 4
+
+# Page size of list_rows and the maximum number of rows per batch_update_rows call
+rows_page_size = 1000
+batch_update_size = 1000
+
+# Pooled connections to the OpenAI API, kept alive between requests
+openai_retry_status_codes = (429, 500, 502, 503, 504)
+openai_session = requests.Session()
+openai_session.mount("https://", HTTPAdapter(pool_maxsize=16))
+
+# Metrics of the OpenAI API calls, see record_api_call
+telemetry_file = None
+telemetry_table = None
+telemetry_columns = {
+    "Time": ColumnTypes.TEXT,
+    "Service": ColumnTypes.TEXT,
+    "Endpoint": ColumnTypes.TEXT,
+    "Model": ColumnTypes.TEXT,
+    "Status": ColumnTypes.TEXT,
+    "Latency ms": ColumnTypes.NUMBER,
+    "TTFB ms": ColumnTypes.NUMBER,
+    "Request bytes": ColumnTypes.NUMBER,
+    "Response bytes": ColumnTypes.NUMBER,
+    "Prompt tokens": ColumnTypes.NUMBER,
+    "Completion tokens": ColumnTypes.NUMBER,
+}
+telemetry_rows = []
+telemetry_lock = threading.Lock()
+
 # Retrieve server URL and API token from the context
 server_url = context.server_url
 api_token = context.api_token
@@ -31,6 +99,7 @@ base.auth()
 # Retrieve the current row and table name from the context
 row = context.current_row
 table_name = context.current_table
+chatgpt_bulk_table = table_name
 
 
 def get_config_values(config_table):
@@ -80,6 +149,295 @@ def check_config_table(config_table):
         raise SystemExit("Config table not found!")
 
 
+def check_telemetry_table(telemetry_table):
+    """
+    Check if the telemetry table exists, and create it with the metric columns if it does not.
+
+    Args:
+        telemetry_table (str): Name of the telemetry table.
+
+    Returns:
+        None
+    """
+    base_metadata = base.get_metadata()
+    if any(table["name"] == telemetry_table for table in base_metadata["tables"]):
+        return
+
+    base.add_table(telemetry_table)
+    for column, column_type in telemetry_columns.items():
+        base.insert_column(telemetry_table, column, column_type)
+
+
+def record_api_call(service, endpoint, model, started_at, response=None, error=None):
+    """
+    Record the metrics of an API call, if the 'telemetry_file' or 'telemetry_table' setting is set.
+
+    The metrics are appended to the JSON lines file right away and buffered for the telemetry
+    table, which is written by flush_telemetry when the script exits.
+
+    Args:
+        service (str): The called service, e.g. "openai".
+        endpoint (str): The called endpoint, e.g. "chat/completions".
+        model (str): The requested model, or None.
+        started_at (float): The time.monotonic() value before the request was sent.
+        response (requests.Response, optional): The response, if one was received.
+        error (Exception, optional): The error, if no response was received.
+
+    Returns:
+        None
+    """
+    if not telemetry_file and not telemetry_table:
+        return
+
+    usage = {}
+    if response is not None:
+        try:
+            usage = response.json().get("usage") or {}
+        except (ValueError, AttributeError):
+            pass
+
+    metrics = {
+        "Time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "Service": service,
+        "Endpoint": endpoint,
+        "Model": model,
+        "Status": str(response.status_code) if response is not None else type(error).__name__,
+        "Latency ms": round((time.monotonic() - started_at) * 1000),
+        # requests measures the time until the response headers arrived
+        "TTFB ms": round(response.elapsed.total_seconds() * 1000) if response is not None else None,
+        "Request bytes": len(response.request.body or b"") if response is not None else None,
+        "Response bytes": len(response.content) if response is not None else None,
+        "Prompt tokens": usage.get("prompt_tokens"),
+        "Completion tokens": usage.get("completion_tokens"),
+    }
+
+    with telemetry_lock:
+        if telemetry_file:
+            with open(telemetry_file, "a") as f:
+                f.write(json.dumps(metrics) + "\n")
+        if telemetry_table:
+            telemetry_rows.append(metrics)
+
+
+def flush_telemetry():
+    """
+    Write the buffered metrics to the telemetry table.
+
+    Returns:
+        None
+    """
+    with telemetry_lock:
+        rows = telemetry_rows[:]
+        del telemetry_rows[:]
+
+    if not rows:
+        return
+
+    check_telemetry_table(telemetry_table)
+    for i in range(0, len(rows), 1000):
+        base.batch_append_rows(telemetry_table, rows[i:i + 1000])
+
+
+def parse_retry_after(response):
+    """
+    Get the number of seconds to wait from the Retry-After header of a response.
+
+    Args:
+        response (requests.Response): The response.
+
+    Returns:
+        float: The number of seconds, or None if the header is missing or invalid.
+    """
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def openai_request(openai_api_key, path, data):
+    """
+    Send a request to the OpenAI API over the pooled session.
+
+    Throttled (429) and failed (5xx) requests, connection errors and timeouts are retried
+    up to `openai_max_retries` times with exponential backoff, honoring Retry-After.
+
+    Args:
+        openai_api_key (str): The OpenAI API key.
+        path (str): The path of the endpoint, e.g. "chat/completions".
+        data (dict): The JSON body of the request.
+
+    Returns:
+        dict: The JSON response.
+
+    Raises:
+        requests.RequestException: If the request still fails after the retries.
+    """
+    url = f"https://api.openai.com/v1/{path}"
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {openai_api_key}"
+    }
+    max_retries = int(openai_max_retries)
+
+    for attempt in range(max_retries + 1):
+        retry_after = None
+        started_at = time.monotonic()
+        try:
+            response = openai_session.post(
+                url, headers=headers, json=data, timeout=float(openai_timeout)
+            )
+            record_api_call("openai", path, data.get("model"), started_at, response)
+            if response.status_code not in openai_retry_status_codes or attempt == max_retries:
+                response.raise_for_status()
+                return response.json()
+            retry_after = parse_retry_after(response)
+            error = f"status code {response.status_code}"
+        except (requests.ConnectionError, requests.Timeout) as e:
+            record_api_call("openai", path, data.get("model"), started_at, error=e)
+            if attempt == max_retries:
+                raise
+            error = e
+
+        # Exponential backoff with jitter, unless the API tells us how long to wait
+        delay = retry_after if retry_after is not None else 2 ** attempt + random.random()
+        print(f"OpenAI request failed ({error}), retrying in {delay:.1f}s...")
+        time.sleep(delay)
+
+
+def open_openai_cache():
+    """
+    Open the SQLite completion cache, if the 'openai_cache_file' setting is set.
+
+    Returns:
+        sqlite3.Connection: The connection to the cache, or None if the cache is disabled.
+    """
+    if not openai_cache_file:
+        return None
+
+    connection = sqlite3.connect(openai_cache_file)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS completions "
+        "(key TEXT PRIMARY KEY, response TEXT, created_at REAL, used_at REAL)"
+    )
+    connection.commit()
+
+    return connection
+
+
+def get_cached_response(key, now):
+    """
+    Look up a response in the completion cache.
+
+    Args:
+        key (str): The cache key of the request.
+        now (float): The current time.
+
+    Returns:
+        dict: The JSON response, or None on a miss.
+    """
+    openai_cache = open_openai_cache()
+    try:
+        found = openai_cache.execute(
+            "SELECT response FROM completions WHERE key = ? AND created_at > ?",
+            (key, now - float(openai_cache_ttl)),
+        ).fetchone()
+        if not found:
+            return None
+
+        openai_cache.execute("UPDATE completions SET used_at = ? WHERE key = ?", (now, key))
+        openai_cache.commit()
+    finally:
+        openai_cache.close()
+
+    return json.loads(found[0])
+
+
+def add_cached_response(key, response_json, now):
+    """
+    Add a response to the completion cache, evicting expired and least recently used responses.
+
+    Args:
+        key (str): The cache key of the request.
+        response_json (dict): The JSON response.
+        now (float): The current time.
+
+    Returns:
+        None
+    """
+    openai_cache = open_openai_cache()
+    try:
+        openai_cache.execute(
+            "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+            (key, json.dumps(response_json), now, now),
+        )
+        # Evict expired responses, then the least recently used ones
+        openai_cache.execute(
+            "DELETE FROM completions WHERE created_at <= ?", (now - float(openai_cache_ttl),)
+        )
+        openai_cache.execute(
+            "DELETE FROM completions WHERE key NOT IN "
+            "(SELECT key FROM completions ORDER BY used_at DESC LIMIT ?)",
+            (int(openai_cache_max_entries),),
+        )
+        openai_cache.commit()
+    finally:
+        openai_cache.close()
+
+
+def cached_openai_request(openai_api_key, path, data):
+    """
+    Send a request to the OpenAI API like openai_request, answering it from the completion
+    cache if the same request was sent within the last `openai_cache_ttl` seconds.
+
+    The cache key is a hash of the endpoint, the model, the messages and the sampling
+    parameters. The cache keeps at most `openai_cache_max_entries` responses and evicts
+    the least recently used ones first. If the cache fails, e.g. because the file is locked
+    by another worker or cannot be written, the request is sent without it.
+
+    Args:
+        openai_api_key (str): The OpenAI API key.
+        path (str): The path of the endpoint, e.g. "chat/completions".
+        data (dict): The JSON body of the request.
+
+    Returns:
+        dict: The JSON response.
+    """
+    if not openai_cache_file:
+        return openai_request(openai_api_key, path, data)
+
+    key = hashlib.sha256(json.dumps({"path": path, "data": data}, sort_keys=True).encode()).hexdigest()
+    now = time.time()
+
+    try:
+        response_json = get_cached_response(key, now)
+    except sqlite3.Error as e:
+        print(f"Failed to read the OpenAI cache, sending the request: {e}")
+        response_json = None
+    if response_json is not None:
+        print("Using the cached OpenAI response")
+        return response_json
+
+    response_json = openai_request(openai_api_key, path, data)
+
+    try:
+        add_cached_response(key, response_json, now)
+    except sqlite3.Error as e:
+        print(f"Failed to write the OpenAI cache: {e}")
+
+    return response_json
+
+
 def call_chatgpt(chatgpt_role, chatgpt_vision_labels, chatgpt_additional_notes):
     """
     Call the ChatGPT API to generate a response based on the provided input.
@@ -92,11 +450,6 @@ def call_chatgpt(chatgpt_role, chatgpt_vision_labels, chatgpt_additional_notes):
     Returns:
         The generated text response from ChatGPT.
     """
-    url = "https://api.openai.com/v1/chat/completions"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {openai_api_key}"
-    }
     data = {
         "messages": [
             {"role": "system", "content": chatgpt_role},
@@ -108,34 +461,117 @@ def call_chatgpt(chatgpt_role, chatgpt_vision_labels, chatgpt_additional_notes):
         "temperature": 0.9,
         "n": 1
     }
-    response = requests.post(url, headers=headers, json=data)
-    generated_text = response.json()["choices"][0]["message"]["content"]
+    response_json = cached_openai_request(openai_api_key, "chat/completions", data)
+    generated_text = response_json["choices"][0]["message"]["content"]
     return generated_text
 
 
-def main():
+def generate_row_text(chatgpt_row):
     """
-    The main function that executes the ChatGPT generation process.
+    Generate the description of a row with ChatGPT.
+
+    Args:
+        chatgpt_row (dict): The row with the role, the vision labels and the optional notes.
 
     Returns:
-        None
+        str: The generated text.
     """
+    # Retrieve the role from the specified column in the row
+    chatgpt_role = chatgpt_row[chatgpt_role_column]
 
-    # Retrieve the role from the specified column in the current row
-    chatgpt_role = row[chatgpt_role_column]
-
-    # Retrieve the vision labels from the specified column in the current row
-    chatgpt_vision_labels = row[chatgpt_vision_labels_column]
+    # Retrieve the vision labels from the specified column in the row
+    chatgpt_vision_labels = chatgpt_row[chatgpt_vision_labels_column]
 
-    # Retrieve the additional notes from the specified column in the current row
-    if chatgpt_additional_notes_column in row:
-        chatgpt_additional_notes = row[chatgpt_additional_notes_column]
+    # Retrieve the additional notes from the specified column in the row
+    if chatgpt_additional_notes_column in chatgpt_row:
+        chatgpt_additional_notes = chatgpt_row[chatgpt_additional_notes_column]
     else:
         chatgpt_additional_notes = ""  # Or you can use an empty list [], if you want an empty array
 
     # Generate the text using the call_chatgpt function
-    generated_text = call_chatgpt(chatgpt_role, chatgpt_vision_labels, chatgpt_additional_notes)
-    
+    return call_chatgpt(chatgpt_role, chatgpt_vision_labels, chatgpt_additional_notes)
+
+
+def bulk_generate(bulk_table, bulk_view=None):
+    """
+    Generate the descriptions of all rows of a table or view that have a role and vision labels
+    but no description yet.
+
+    The rows are read page by page. The descriptions of a page are generated by up to
+    `chatgpt_concurrency` parallel requests and written back with batch updates.
+    Rows whose request fails are counted and left for the next run.
+
+    Args:
+        bulk_table (str): The name of the table.
+        bulk_view (str, optional): The name of a view that limits the rows.
+
+    Returns:
+        None
+    """
+    start = 0
+    read_rows = 0
+    generated_rows = 0
+    errors = 0
+    started_at = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=int(chatgpt_concurrency)) as executor:
+        while True:
+            rows = base.list_rows(bulk_table, view_name=bulk_view, start=start, limit=rows_page_size)
+            if not rows:
+                break
+            start += len(rows)
+
+            # Skip the rows that have a description already or lack the inputs
+            futures = {
+                executor.submit(generate_row_text, bulk_row): bulk_row
+                for bulk_row in rows
+                if bulk_row.get(chatgpt_role_column)
+                and bulk_row.get(chatgpt_vision_labels_column)
+                and not bulk_row.get(chatgpt_output_column)
+            }
+
+            updates = []
+            for future in as_completed(futures):
+                bulk_row = futures[future]
+                try:
+                    generated_text = future.result()
+                except (requests.RequestException, KeyError, IndexError) as e:
+                    print(f"Failed to generate the description of row {bulk_row['_id']}: {e}")
+                    errors += 1
+                    continue
+
+                updates.append({"row_id": bulk_row["_id"], "row": {chatgpt_output_column: generated_text}})
+                if len(updates) == batch_update_size:
+                    base.batch_update_rows(bulk_table, updates)
+                    generated_rows += len(updates)
+                    updates = []
+
+            if updates:
+                base.batch_update_rows(bulk_table, updates)
+                generated_rows += len(updates)
+
+            read_rows += len(rows)
+            elapsed = max(time.monotonic() - started_at, 0.001)
+            print(
+                f"Read {read_rows} rows: {generated_rows} generated, {errors} failed "
+                f"({read_rows / elapsed:.1f} rows/s, {generated_rows / elapsed:.1f} generated rows/s)"
+            )
+
+            if len(rows) < rows_page_size:
+                break
+
+
+def main():
+    """
+    The main function that executes the ChatGPT generation process.
+
+    Returns:
+        None
+    """
+
+    # Generate the text for the current row
+    generated_text = generate_row_text(row)
+
     # Prepare the updated row data with the generated text
     row_data = {
         chatgpt_output_column: generated_text
@@ -153,8 +589,14 @@ if __name__ == "__main__":
     config_values = get_config_values(config_table)
     locals().update(config_values)
 
+    # Write the buffered metrics when the script ends
+    atexit.register(flush_telemetry)
+
     # Call the main function
-    main()
+    if chatgpt_mode == "bulk":
+        bulk_generate(chatgpt_bulk_table, chatgpt_bulk_view)
+    else:
+        main()
 
     # Terminate the script execution
     exit()
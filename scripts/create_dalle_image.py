@@ -1,21 +1,64 @@
 """
 This script is used to configure and interact with Seatable API and DALL-E.
 It requires the `seatable-api` package to be installed.
+
+Optional settings in the "_settings" table:
+- openai_timeout: the timeout of OpenAI API requests in seconds (default: 120).
+- openai_max_retries: how often throttled or failed OpenAI API requests are retried (default: 5).
+- telemetry_file: path of a JSON lines file that receives the metrics of every OpenAI API call:
+  latency, time to first byte, request and response bytes, prompt and completion tokens, model and status.
+- telemetry_table: name of a table that receives the same metrics when the script ends. It is created if it
+  does not exist.
 """
 
 __author__ = "Vitali Quiering"
-__version__ = "1.0.0"
+__version__ = "1.2.0"
+import atexit
+import datetime
+import email.utils
 import requests
 import json
 import random
 import string
+import threading
+import time
+from requests.adapters import HTTPAdapter
 from seatable_api import Base, context
+from seatable_api.constants import ColumnTypes
 
 # Configuration variables
 CONFIG_TABLE = "_settings"
 DALLE_PROMPT_COLUMN = "Image Prompt for DALL-E"
 DALLE_OUTPUT_COLUMN = "Image"
 
+# Defaults of the optional settings
+openai_timeout = 120
+openai_max_retries = 5
+
+# Pooled connections to the OpenAI API, kept alive between requests
+openai_retry_status_codes = (429, 500, 502, 503, 504)
+openai_session = requests.Session()
+openai_session.mount("https://", HTTPAdapter(pool_maxsize=16))
+
+# Metrics of the OpenAI API calls, see record_api_call
+telemetry_file = None
+telemetry_table = None
+telemetry_columns = {
+    "Time": ColumnTypes.TEXT,
+    "Service": ColumnTypes.TEXT,
+    "Endpoint": ColumnTypes.TEXT,
+    "Model": ColumnTypes.TEXT,
+    "Status": ColumnTypes.TEXT,
+    "Latency ms": ColumnTypes.NUMBER,
+    "TTFB ms": ColumnTypes.NUMBER,
+    "Request bytes": ColumnTypes.NUMBER,
+    "Response bytes": ColumnTypes.NUMBER,
+    "Prompt tokens": ColumnTypes.NUMBER,
+    "Completion tokens": ColumnTypes.NUMBER,
+}
+telemetry_rows = []
+telemetry_lock = threading.Lock()
+
 # Retrieve server URL and API token from the context
 SERVER_URL = context.server_url
 API_TOKEN = context.api_token
@@ -76,28 +119,189 @@ def check_config_table(config_table):
         raise SystemExit("Config table not found!")
 
 
-def get_dalle_url(dalle_prompt):
+def check_telemetry_table(telemetry_table):
     """
-    Call the DALL-E API to generate an image based on the provided input.
+    Check if the telemetry table exists, and create it with the metric columns if it does not.
 
     Args:
-        dalle_prompt (str): The prompt for the DALL-E image generation.
+        telemetry_table (str): Name of the telemetry table.
 
     Returns:
-        str: The URL of the generated image.
+        None
+    """
+    base_metadata = base.get_metadata()
+    if any(table["name"] == telemetry_table for table in base_metadata["tables"]):
+        return
+
+    base.add_table(telemetry_table)
+    for column, column_type in telemetry_columns.items():
+        base.insert_column(telemetry_table, column, column_type)
+
+
+def record_api_call(service, endpoint, model, started_at, response=None, error=None):
+    """
+    Record the metrics of an API call, if the 'telemetry_file' or 'telemetry_table' setting is set.
+
+    The metrics are appended to the JSON lines file right away and buffered for the telemetry
+    table, which is written by flush_telemetry when the script exits.
+
+    Args:
+        service (str): The called service, e.g. "openai".
+        endpoint (str): The called endpoint, e.g. "chat/completions".
+        model (str): The requested model, or None.
+        started_at (float): The time.monotonic() value before the request was sent.
+        response (requests.Response, optional): The response, if one was received.
+        error (Exception, optional): The error, if no response was received.
+
+    Returns:
+        None
+    """
+    if not telemetry_file and not telemetry_table:
+        return
+
+    usage = {}
+    if response is not None:
+        try:
+            usage = response.json().get("usage") or {}
+        except (ValueError, AttributeError):
+            pass
+
+    metrics = {
+        "Time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "Service": service,
+        "Endpoint": endpoint,
+        "Model": model,
+        "Status": str(response.status_code) if response is not None else type(error).__name__,
+        "Latency ms": round((time.monotonic() - started_at) * 1000),
+        # requests measures the time until the response headers arrived
+        "TTFB ms": round(response.elapsed.total_seconds() * 1000) if response is not None else None,
+        "Request bytes": len(response.request.body or b"") if response is not None else None,
+        "Response bytes": len(response.content) if response is not None else None,
+        "Prompt tokens": usage.get("prompt_tokens"),
+        "Completion tokens": usage.get("completion_tokens"),
+    }
+
+    with telemetry_lock:
+        if telemetry_file:
+            with open(telemetry_file, "a") as f:
+                f.write(json.dumps(metrics) + "\n")
+        if telemetry_table:
+            telemetry_rows.append(metrics)
+
+
+def flush_telemetry():
+    """
+    Write the buffered metrics to the telemetry table.
+
+    Returns:
+        None
+    """
+    with telemetry_lock:
+        rows = telemetry_rows[:]
+        del telemetry_rows[:]
+
+    if not rows:
+        return
+
+    check_telemetry_table(telemetry_table)
+    for i in range(0, len(rows), 1000):
+        base.batch_append_rows(telemetry_table, rows[i:i + 1000])
+
+
+def parse_retry_after(response):
+    """
+    Get the number of seconds to wait from the Retry-After header of a response.
+
+    Args:
+        response (requests.Response): The response.
+
+    Returns:
+        float: The number of seconds, or None if the header is missing or invalid.
+    """
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def openai_request(openai_api_key, path, data):
+    """
+    Send a request to the OpenAI API over the pooled session.
+
+    Throttled (429) and failed (5xx) requests, connection errors and timeouts are retried
+    up to `openai_max_retries` times with exponential backoff, honoring Retry-After.
+
+    Args:
+        openai_api_key (str): The OpenAI API key.
+        path (str): The path of the endpoint, e.g. "chat/completions".
+        data (dict): The JSON body of the request.
+
+    Returns:
+        dict: The JSON response.
+
+    Raises:
+        requests.RequestException: If the request still fails after the retries.
     """
-    url = "https://api.openai.com/v1/images/generations"
+    url = f"https://api.openai.com/v1/{path}"
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {openai_api_key}"
     }
+    max_retries = int(openai_max_retries)
+
+    for attempt in range(max_retries + 1):
+        retry_after = None
+        started_at = time.monotonic()
+        try:
+            response = openai_session.post(
+                url, headers=headers, json=data, timeout=float(openai_timeout)
+            )
+            record_api_call("openai", path, data.get("model"), started_at, response)
+            if response.status_code not in openai_retry_status_codes or attempt == max_retries:
+                response.raise_for_status()
+                return response.json()
+            retry_after = parse_retry_after(response)
+            error = f"status code {response.status_code}"
+        except (requests.ConnectionError, requests.Timeout) as e:
+            record_api_call("openai", path, data.get("model"), started_at, error=e)
+            if attempt == max_retries:
+                raise
+            error = e
+
+        # Exponential backoff with jitter, unless the API tells us how long to wait
+        delay = retry_after if retry_after is not None else 2 ** attempt + random.random()
+        print(f"OpenAI request failed ({error}), retrying in {delay:.1f}s...")
+        time.sleep(delay)
+
+
+def get_dalle_url(dalle_prompt):
+    """
+    Call the DALL-E API to generate an image based on the provided input.
+
+    Args:
+        dalle_prompt (str): The prompt for the DALL-E image generation.
+
+    Returns:
+        str: The URL of the generated image.
+    """
     data = {
         "prompt": f"{dalle_prompt}",
         "size": "1024x1024",
         "n": 1
     }
-    response = requests.post(url, headers=headers, json=data)
-    generated_image_url = response.json()["data"][0]["url"]
+    response_json = openai_request(openai_api_key, "images/generations", data)
+    generated_image_url = response_json["data"][0]["url"]
     return generated_image_url
 
 
@@ -115,7 +319,8 @@ def main():
     # Generate the image using the call_dalle function
     generated_image_url = get_dalle_url(dalle_prompt)
 
-    generated_image = requests.get(generated_image_url)
+    generated_image = openai_session.get(generated_image_url, timeout=float(openai_timeout))
+    generated_image.raise_for_status()
 
     # Generate a random 8-character string
     random_str = ''.join(random.choices(string.ascii_letters + string.digits, k=8))
@@ -140,6 +345,9 @@ if __name__ == "__main__":
     config_values = get_config_values(CONFIG_TABLE)
     locals().update(config_values)
 
+    # Write the buffered metrics when the script ends
+    atexit.register(flush_telemetry)
+
     # Call the main function
     main()
 
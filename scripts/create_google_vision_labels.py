@@ -1,23 +1,95 @@
 """
 This script is designed to interact with the SeaTable API and perform operations related to Google Vision API labels.
 It requires the `seatable-api` package to be installed.
+
+Optional settings in the "_settings" table:
+- google_vision_label_cache_file: path of a SQLite file that caches the labels of images by their content,
+  so identical images are only sent to the Google Vision API once.
+- google_vision_label_cache_bytes: the maximum size of the cached labels in bytes (default: 64 MB).
+- google_vision_use_image_uri: set to 'true' to let the Google Vision API fetch the images from a temporary
+  download link instead of uploading their content. The SeaTable server must be reachable from the internet.
+- google_vision_max_image_size: downscale images to this size in pixels (longest edge, e.g. 640) before
+  they are sent to the Google Vision API. Requires the `Pillow` package.
+- google_vision_mode: 'row' to label the current row (default), 'backfill' to label all rows of a table
+  that have images but no labels yet.
+- google_vision_backfill_table: the table that is labelled in 'backfill' mode (default: the current table).
+- google_vision_backfill_view: optional view that limits the rows in 'backfill' mode. Do not filter the view
+  on the labels column, the rows are paged by offset.
+- google_vision_concurrency: the number of images that are downloaded and requests that are sent at the
+  same time (default: 4).
+- google_vision_requests_per_minute: optional limit of the Google Vision API requests per minute, to stay
+  within your quota.
+- google_vision_max_retries: how often throttled or failed Google Vision API requests are retried (default: 5).
+- google_vision_label_index_table: optional name of a table that is kept up to date as an inverted index
+  of the labels. It has one row per label, linked to the labelled rows, whose labels column holds the scores.
+  To find all rows labelled "Dog", look up the row "Dog" in this table instead of scanning all labels.
+- google_vision_phash_distance: reuse the labels of an already labelled image if a new image differs from it
+  by at most this many bits of their perceptual hashes (e.g. 4), e.g. for re-uploads or re-compressed copies.
+  Requires the label cache and the `Pillow` package.
+- telemetry_file: path of a JSON lines file that receives the metrics of every Google Vision API call:
+  latency, time to first byte, request and response bytes and status.
+- telemetry_table: name of a table that receives the same metrics when the script ends. It is created if it
+  does not exist.
 """
 
 __author__ = "Vitali Quiering"
-__version__ = "1.0.2"
+__version__ = "1.8.0"
 
+import atexit
+import datetime
+import email.utils
 import os
+import queue
+import random
 import requests
 import base64
+import ast
+import hashlib
+import io
 import json
+import sqlite3
+import threading
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from seatable_api import Base, context
+from seatable_api.constants import ColumnTypes
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 # config
 config_table = "_settings"
 image_column = "Image"
 google_vision_label_column = "Google Vision API Labels"
 
+# Limits of one images:annotate request, see https://cloud.google.com/vision/quotas
+vision_batch_images = 16
+vision_batch_bytes = 8 * 1024 * 1024
+vision_concurrency = 4
+vision_features = [{"type": "LABEL_DETECTION"}]
+vision_jpeg_quality = 85
+vision_retry_status_codes = (429, 500, 502, 503, 504)
+rows_page_size = 1000
+batch_update_size = 1000
+label_index_flush_pages = 10
+# The number of images per group of rows in the backfill, at most a few groups are held in memory
+backfill_group_images = 2 * vision_batch_images
+
+# Defaults of the optional settings
+google_vision_label_cache_file = None
+google_vision_label_cache_bytes = 64 * 1024 * 1024
+google_vision_use_image_uri = None
+google_vision_max_image_size = None
+google_vision_mode = "row"
+google_vision_backfill_view = None
+google_vision_requests_per_minute = None
+google_vision_max_retries = 5
+google_vision_label_index_table = None
+google_vision_phash_distance = None
+
 server_url = context.server_url
 api_token = context.api_token
 
@@ -28,6 +100,69 @@ base.auth()
 row = context.current_row
 table_name = context.current_table
 
+google_vision_backfill_table = table_name
+
+# Limits the Google Vision API requests, see TokenBucket
+vision_rate_limiter = None
+
+# Perceptual hashes of the labelled images, loaded once per run, see load_dhash_index
+dhash_index = None
+
+# Metrics of the Google Vision API calls, see record_api_call
+telemetry_file = None
+telemetry_table = None
+telemetry_columns = {
+    "Time": ColumnTypes.TEXT,
+    "Service": ColumnTypes.TEXT,
+    "Endpoint": ColumnTypes.TEXT,
+    "Model": ColumnTypes.TEXT,
+    "Status": ColumnTypes.TEXT,
+    "Latency ms": ColumnTypes.NUMBER,
+    "TTFB ms": ColumnTypes.NUMBER,
+    "Request bytes": ColumnTypes.NUMBER,
+    "Response bytes": ColumnTypes.NUMBER,
+    "Prompt tokens": ColumnTypes.NUMBER,
+    "Completion tokens": ColumnTypes.NUMBER,
+}
+telemetry_rows = []
+telemetry_lock = threading.Lock()
+
+class TokenBucket:
+    """
+    A thread-safe token bucket that limits the rate of requests.
+
+    The bucket holds up to `capacity` tokens and is refilled with `rate` tokens per second.
+    Each request takes one token and waits while the bucket is empty.
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        Args:
+            rate (float): The number of tokens added per second.
+            capacity (int): The maximum number of tokens, i.e. the allowed burst of requests.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting until one is available."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
 def process_image_labels():
     """
     Processes the labels of an image using the Google Vision API.
@@ -135,114 +270,1239 @@ def check_config_table(config_table):
     if not config_table_found:
         raise SystemExit("Config table not found!")
 
-def download_image(image_url):
+def check_telemetry_table(telemetry_table):
+    """
+    Check if the telemetry table exists, and create it with the metric columns if it does not.
+
+    Args:
+        telemetry_table (str): Name of the telemetry table.
+
+    Returns:
+        None
+    """
+    base_metadata = base.get_metadata()
+    if any(table["name"] == telemetry_table for table in base_metadata["tables"]):
+        return
+
+    base.add_table(telemetry_table)
+    for column, column_type in telemetry_columns.items():
+        base.insert_column(telemetry_table, column, column_type)
+
+def record_api_call(service, endpoint, model, started_at, response=None, error=None):
+    """
+    Record the metrics of an API call, if the 'telemetry_file' or 'telemetry_table' setting is set.
+
+    The metrics are appended to the JSON lines file right away and buffered for the telemetry
+    table, which is written by flush_telemetry when the script exits.
+
+    Args:
+        service (str): The called service, e.g. "openai".
+        endpoint (str): The called endpoint, e.g. "chat/completions".
+        model (str): The requested model, or None.
+        started_at (float): The time.monotonic() value before the request was sent.
+        response (requests.Response, optional): The response, if one was received.
+        error (Exception, optional): The error, if no response was received.
+
+    Returns:
+        None
+    """
+    if not telemetry_file and not telemetry_table:
+        return
+
+    usage = {}
+    if response is not None:
+        try:
+            usage = response.json().get("usage") or {}
+        except (ValueError, AttributeError):
+            pass
+
+    metrics = {
+        "Time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "Service": service,
+        "Endpoint": endpoint,
+        "Model": model,
+        "Status": str(response.status_code) if response is not None else type(error).__name__,
+        "Latency ms": round((time.monotonic() - started_at) * 1000),
+        # requests measures the time until the response headers arrived
+        "TTFB ms": round(response.elapsed.total_seconds() * 1000) if response is not None else None,
+        "Request bytes": len(response.request.body or b"") if response is not None else None,
+        "Response bytes": len(response.content) if response is not None else None,
+        "Prompt tokens": usage.get("prompt_tokens"),
+        "Completion tokens": usage.get("completion_tokens"),
+    }
+
+    with telemetry_lock:
+        if telemetry_file:
+            with open(telemetry_file, "a") as f:
+                f.write(json.dumps(metrics) + "\n")
+        if telemetry_table:
+            telemetry_rows.append(metrics)
+
+def flush_telemetry():
+    """
+    Write the buffered metrics to the telemetry table.
+
+    Returns:
+        None
+    """
+    with telemetry_lock:
+        rows = telemetry_rows[:]
+        del telemetry_rows[:]
+
+    if not rows:
+        return
+
+    check_telemetry_table(telemetry_table)
+    for i in range(0, len(rows), 1000):
+        base.batch_append_rows(telemetry_table, rows[i:i + 1000])
+
+def parse_retry_after(response):
+    """
+    Get the number of seconds to wait from the Retry-After header of a response.
+
+    Args:
+        response (requests.Response): The response.
+
+    Returns:
+        float: The number of seconds, or None if the header is missing or invalid.
     """
-    Download an image from the specified URL and return its Base64-encoded content.
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
 
-    This function downloads an image from the given URL and saves it to the local file system.
-    It then reads the content of the image file, encodes it as Base64, and returns the Base64-encoded content.
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+def get_image_download_link(image_url):
+    """
+    Get a temporary download link for an image stored in SeaTable.
 
     Args:
-        image_url (str): URL of the image to download.
+        image_url (str): URL of the image in the 'Image' column.
 
     Returns:
-        str: Base64-encoded content of the downloaded image.
+        str: The download link.
     """
-    # Extract the filename from the image URL
-    image_path = os.path.basename(urllib.parse.urlparse(image_url).path)
+    # Same path handling as base.download_file
+    path = urllib.parse.unquote(image_url.split(str(base.dtable_uuid))[-1].strip("/"))
+
+    return base.get_file_download_link(path)
 
-    # Download the image file
-    base.download_file(image_url, image_path)
+def downscale_image(image_content):
+    """
+    Downscale an image to `google_vision_max_image_size` pixels and re-encode it as JPEG.
 
-    # Read the image file
-    with open(image_path, "rb") as image_file:
-        image_content = image_file.read()
+    Label detection works as well on small images, and small images make much smaller requests.
+    The image is returned unchanged if it is already small enough, if downscaling does not make
+    it smaller, or if the `Pillow` package is not installed.
 
-    # Encode the image content as Base64
-    encoded_image_content = base64.b64encode(image_content).decode("utf-8")
+    Args:
+        image_content (bytes): The content of the image.
 
-    return encoded_image_content
+    Returns:
+        bytes: The content of the downscaled image.
+    """
+    if not google_vision_max_image_size:
+        return image_content
+
+    if Image is None:
+        print("Install the 'Pillow' package to downscale images.")
+        return image_content
+
+    max_size = int(google_vision_max_image_size)
+    try:
+        with Image.open(io.BytesIO(image_content)) as image:
+            if max(image.size) <= max_size:
+                return image_content
+
+            image.thumbnail((max_size, max_size))
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+
+            output = io.BytesIO()
+            image.save(output, format="JPEG", quality=vision_jpeg_quality)
+    except OSError as e:
+        print(f"Failed to downscale an image, sending it as it is: {e}")
+        return image_content
+
+    downscaled_content = output.getvalue()
+
+    return downscaled_content if len(downscaled_content) < len(image_content) else image_content
+
+def compute_dhash(image_content):
+    """
+    Compute the perceptual difference hash (dHash) of an image.
+
+    The image is reduced to 9x8 grayscale pixels, and each bit of the 64-bit hash tells if a
+    pixel is brighter than its right neighbour. Re-compressed or resized copies of an image
+    have the same or an almost identical hash.
+
+    Args:
+        image_content (bytes): The content of the image.
+
+    Returns:
+        int: The hash, or None if perceptual hashing is disabled or the image cannot be read.
+    """
+    if not google_vision_phash_distance or Image is None:
+        return None
+
+    try:
+        with Image.open(io.BytesIO(image_content)) as image:
+            pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    except OSError as e:
+        print(f"Failed to compute the perceptual hash of an image: {e}")
+        return None
+
+    dhash = 0
+    for y in range(8):
+        for x in range(8):
+            dhash = (dhash << 1) | (pixels[y * 9 + x] > pixels[y * 9 + x + 1])
+
+    return dhash
+
+def fetch_image(image_url):
+    """
+    Fetch an image from the specified URL for the Google Vision API.
+
+    This function downloads the image into memory, downscales it (see downscale_image) and encodes
+    it as Base64 right away, so only the encoded content is kept. With the 'google_vision_use_image_uri'
+    setting, the image is not downloaded at all and the Google Vision API fetches it from a temporary
+    download link instead.
+
+    Args:
+        image_url (str): URL of the image to fetch.
+
+    Returns:
+        dict: The image with the keys 'content' (Base64-encoded content as bytes, or None),
+            'uri' (download link for the Google Vision API, or None), 'key' (a hash
+            that identifies the image, see get_label_cache_key), 'dhash' (the perceptual
+            hash, see compute_dhash) and 'saved_bytes' (the number of bytes saved by downscaling).
+    """
+    download_link = get_image_download_link(image_url)
+
+    if str(google_vision_use_image_uri).lower() in ("1", "true", "yes"):
+        # The content is unknown, identify the image by its stable URL
+        image_hash = hashlib.sha256(image_url.encode()).hexdigest()
+        return {
+            "content": None,
+            "uri": download_link,
+            "key": f"uri:{image_hash}",
+            "dhash": None,
+            "saved_bytes": 0,
+        }
+
+    response = requests.get(download_link)
+    if response.status_code != 200:
+        raise ValueError(f"Failed to download {image_url}. Status code: {response.status_code}")
+
+    # Hash the original content, the downscaling settings are part of the cache key
+    image_hash = hashlib.sha256(response.content).hexdigest()
+    image_content = downscale_image(response.content)
+
+    return {
+        "content": base64.b64encode(image_content),
+        "uri": None,
+        "key": image_hash,
+        "dhash": compute_dhash(image_content),
+        "saved_bytes": len(response.content) - len(image_content),
+    }
 
 def get_images():
     """
-    Get the Base64-encoded content of images from the 'Image' column in the current row.
+    Get the images from the 'Image' column in the current row.
 
     This function retrieves the URLs of images from the 'Image' column in the current row.
-    It then calls the 'download_image' function to download each image and get its Base64-encoded content.
-    The Base64-encoded contents of the images are stored in a list and returned.
+    It then calls the 'fetch_image' function to fetch each image for the Google Vision API.
 
     Returns:
-        list: A list of Base64-encoded contents of the downloaded images.
+        list: A list of images, see fetch_image.
     """
-    encoded_images = []
+    images = []
     for image_url in row[image_column]:
-        encoded_image = download_image(image_url)
-        encoded_images.append(encoded_image)
+        image = fetch_image(image_url)
+        images.append(image)
 
-    return encoded_images
+    saved_bytes = sum(image["saved_bytes"] for image in images)
+    if saved_bytes:
+        print(f"Downscaling saved {saved_bytes} bytes")
 
-def google_vision_process(encoded_image):
+    return images
+
+def build_vision_request_body(images):
     """
-    Process the labels of an image using the Google Vision API.
+    Build the JSON body of an images:annotate request.
 
-    This function sends a request to the Google Vision API to obtain labels for the specified image,
-    based on its Base64-encoded content.
-    It returns a list of tuples, where each tuple contains the label description and the label score.
+    The body is assembled from bytes, so the Base64-encoded contents are copied only once
+    instead of passing through a dict, a JSON string and its encoding.
 
     Args:
-        encoded_image (str): Base64-encoded content of the image.
+        images (list): The images, see fetch_image.
 
     Returns:
-        list: A list of tuples containing label descriptions and scores.
+        bytes: The request body.
     """
-    google_vision_payload = {
-        "requests": [
-            {
-                "image": {"content": encoded_image},
-                "features": [{"type": "LABEL_DETECTION"}],
-            }
-        ]
-    }
+    features = json.dumps(vision_features).encode()
+
+    parts = [b'{"requests": [']
+    for index, image in enumerate(images):
+        if index:
+            parts.append(b", ")
+        if image["content"] is None:
+            parts.append(b'{"image": ' + json.dumps({"source": {"imageUri": image["uri"]}}).encode())
+        else:
+            parts.extend([b'{"image": {"content": "', image["content"], b'"}'])
+        parts.append(b', "features": ' + features + b"}")
+    parts.append(b"]}")
+
+    return b"".join(parts)
+
+def extract_labels(image_response):
+    """
+    Extract the labels from the Google Vision API response for one image.
+
+    Args:
+        image_response (dict): The response for the image.
+
+    Returns:
+        list: A list of tuples containing label descriptions and scores, or None if the
+            Google Vision API returned an error for the image.
+    """
+    if "error" in image_response:
+        print(f"Label detection failed for an image: {image_response['error'].get('message')}")
+        return None
+
+    labels = image_response.get("labelAnnotations", [])
+    label_results = []
+    for label in labels:
+        label_description = label["description"]
+        label_score = label["score"]
+        label_results.append((label_description, label_score))
+    return label_results
+
+def google_vision_process_batch(images):
+    """
+    Process the labels of several images with one Google Vision API request.
+
+    This function sends one request with all specified images to the Google Vision API.
+    It returns the labels for each image, in the order of the images.
+    Throttled (429) and failed (5xx) requests, connection errors and timeouts are retried
+    up to `google_vision_max_retries` times with exponential backoff, honoring Retry-After.
+
+    Args:
+        images (list): The images, see fetch_image.
+
+    Returns:
+        list: A list with a list of tuples containing label descriptions and scores per image,
+            or None for an image the Google Vision API returned an error for.
+
+    Raises:
+        ValueError: If the Google Vision API did not return the labels.
+        requests.RequestException: If the request still fails after the retries.
+    """
+    google_vision_payload = build_vision_request_body(images)
 
-    # Make the API request
     api_url = "https://vision.googleapis.com/v1/images:annotate?key=" + google_vision_api_key
-    response = requests.post(api_url, json=google_vision_payload)
+    headers = {"Content-Type": "application/json"}
+    max_retries = int(google_vision_max_retries)
+
+    for attempt in range(max_retries + 1):
+        # Stay within the quota of the Google Vision API
+        if vision_rate_limiter:
+            vision_rate_limiter.acquire()
+
+        # Make the API request
+        retry_after = None
+        started_at = time.monotonic()
+        try:
+            response = requests.post(api_url, headers=headers, data=google_vision_payload)
+            record_api_call("google_vision", "images:annotate", None, started_at, response)
+            if response.status_code not in vision_retry_status_codes or attempt == max_retries:
+                break
+            retry_after = parse_retry_after(response)
+            error = f"status code {response.status_code}"
+        except (requests.ConnectionError, requests.Timeout) as e:
+            record_api_call("google_vision", "images:annotate", None, started_at, error=e)
+            if attempt == max_retries:
+                raise
+            error = e
+        except requests.RequestException as e:
+            record_api_call("google_vision", "images:annotate", None, started_at, error=e)
+            raise
+
+        # Exponential backoff with jitter, unless the API tells us how long to wait
+        delay = retry_after if retry_after is not None else 2 ** attempt + random.random()
+        print(f"Google Vision API request failed ({error}), retrying in {delay:.1f}s...")
+        time.sleep(delay)
+
+    if response.status_code != 200:
+        raise ValueError(
+            f"Label detection failed. Status code: {response.status_code}, error: {response.text}"
+        )
 
     # Parse the response
     response_json = response.json()
 
-    # Extract and print the labels
-    if "responses" in response_json and len(response_json["responses"]) > 0:
-        labels = response_json["responses"][0].get("labelAnnotations", [])
-        label_results = []
-        for label in labels:
-            label_description = label["description"]
-            label_score = label["score"]
-            label_results.append((label_description, label_score))
-        return label_results
+    # Extract the labels, the responses are in the order of the requests
+    if "responses" in response_json and len(response_json["responses"]) == len(images):
+        return [extract_labels(image_response) for image_response in response_json["responses"]]
     else:
-        print("Label detection failed.")
-        exit()
+        raise ValueError(f"Label detection failed. Error: {response.text}")
+
+def plan_vision_batches(images):
+    """
+    Group images into batches that fit into one Google Vision API request.
+
+    A batch holds at most `vision_batch_images` images and `vision_batch_bytes` of
+    Base64-encoded content. A larger image gets a batch of its own.
+
+    Args:
+        images (list): The images, see fetch_image.
+
+    Returns:
+        list: A list of batches, each a list of images.
+    """
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for image in images:
+        image_bytes = len(image["content"] or b"")
+        if batch and (
+            len(batch) >= vision_batch_images
+            or batch_bytes + image_bytes > vision_batch_bytes
+        ):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(image)
+        batch_bytes += image_bytes
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+def open_label_cache():
+    """
+    Open the SQLite label cache, if the 'google_vision_label_cache_file' setting is set.
+
+    Returns:
+        sqlite3.Connection: The connection to the cache, or None if the cache is disabled.
+    """
+    if not google_vision_label_cache_file:
+        return None
+
+    connection = sqlite3.connect(google_vision_label_cache_file)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS labels "
+        "(key TEXT PRIMARY KEY, labels TEXT, size INTEGER, used_at REAL)"
+    )
+    connection.execute("CREATE INDEX IF NOT EXISTS labels_used_at ON labels (used_at)")
+    connection.execute("CREATE TABLE IF NOT EXISTS dhashes (dhash TEXT PRIMARY KEY, key TEXT)")
+    connection.execute("CREATE INDEX IF NOT EXISTS dhashes_key ON dhashes (key)")
+    connection.commit()
+
+    return connection
+
+def get_label_cache_key(image):
+    """
+    Get the cache key of an image: the SHA-256 of its content and of the requested features
+    and image size.
+
+    Args:
+        image (dict): The image, see fetch_image.
+
+    Returns:
+        str: The cache key.
+    """
+    image_hash = image["key"]
+    features = {"features": vision_features, "max_image_size": google_vision_max_image_size}
+    features_hash = hashlib.sha256(json.dumps(features, sort_keys=True).encode()).hexdigest()
+
+    return f"{image_hash}:{features_hash}"
+
+def get_cached_labels(label_cache, key):
+    """
+    Look up the labels of an image in the label cache.
+
+    Args:
+        label_cache (sqlite3.Connection): The label cache.
+        key (str): The cache key of the image.
+
+    Returns:
+        list: A list of tuples containing label descriptions and scores, or None on a miss.
+    """
+    found = label_cache.execute("SELECT labels FROM labels WHERE key = ?", (key,)).fetchone()
+    if not found:
+        return None
+
+    # Remember the use, the least recently used labels are evicted first
+    label_cache.execute("UPDATE labels SET used_at = ? WHERE key = ?", (time.time(), key))
+
+    return [tuple(label) for label in json.loads(found[0])]
+
+def get_label_cache_bytes(label_cache):
+    """
+    Get the size of the labels in the label cache.
+
+    Args:
+        label_cache (sqlite3.Connection): The label cache.
+
+    Returns:
+        int: The size in bytes.
+    """
+    return label_cache.execute("SELECT COALESCE(SUM(size), 0) FROM labels").fetchone()[0]
+
+def add_cached_labels(label_cache, key, labels, cache_bytes):
+    """
+    Add the labels of an image to the label cache, evicting the least recently used
+    labels while the cache is larger than `google_vision_label_cache_bytes`.
+
+    The changes are not committed, see annotate_images.
+
+    Args:
+        label_cache (sqlite3.Connection): The label cache.
+        key (str): The cache key of the image.
+        labels (list): A list of tuples containing label descriptions and scores.
+        cache_bytes (int): The size of the cache before the labels are added, see get_label_cache_bytes.
+
+    Returns:
+        int: The size of the cache after the labels were added.
+    """
+    serialized_labels = json.dumps(labels)
+    replaced = label_cache.execute("SELECT size FROM labels WHERE key = ?", (key,)).fetchone()
+    label_cache.execute(
+        "INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?)",
+        (key, serialized_labels, len(serialized_labels), time.time()),
+    )
+    cache_bytes += len(serialized_labels) - (replaced[0] if replaced else 0)
+
+    max_cache_bytes = int(google_vision_label_cache_bytes)
+    while cache_bytes > max_cache_bytes:
+        evictions = label_cache.execute(
+            "SELECT key, size FROM labels WHERE key != ? ORDER BY used_at LIMIT 100", (key,)
+        ).fetchall()
+        if not evictions:
+            break
+        for evicted_key, size in evictions:
+            if cache_bytes <= max_cache_bytes:
+                break
+            label_cache.execute("DELETE FROM labels WHERE key = ?", (evicted_key,))
+            forget_dhashes(label_cache, evicted_key)
+            cache_bytes -= size
+
+    return cache_bytes
+
+def get_dhash_bands(dhash, bands):
+    """
+    Split a perceptual hash into bands of bits.
+
+    If two hashes differ in at most n bits, at least one of n + 1 bands is equal in both,
+    so the bands find all candidates within a distance without comparing all hashes.
+
+    Args:
+        dhash (int): The 64-bit hash.
+        bands (int): The number of bands.
+
+    Returns:
+        list: A list of (band number, band bits) tuples.
+    """
+    bounds = [band * 64 // bands for band in range(bands + 1)]
+
+    return [
+        (band, (dhash >> bounds[band]) & ((1 << (bounds[band + 1] - bounds[band])) - 1))
+        for band in range(bands)
+    ]
+
+def add_dhash(dhash, key):
+    """
+    Add the perceptual hash of a labelled image to the loaded `dhash_index`.
+
+    Args:
+        dhash (int): The hash of the image.
+        key (str): The cache key of the labels of the image.
+
+    Returns:
+        None
+    """
+    for band in get_dhash_bands(dhash, int(google_vision_phash_distance) + 1):
+        dhash_index.setdefault(band, {})[dhash] = key
+
+def load_dhash_index(label_cache):
+    """
+    Load the perceptual hashes of the labelled images from the label cache into `dhash_index`,
+    unless they were loaded already. The index is then kept up to date by annotate_images and
+    forget_dhashes, so it is only read once per run.
+
+    The index maps (band number, band bits) tuples to dictionaries mapping hashes to cache keys,
+    see get_dhash_bands.
+
+    Args:
+        label_cache (sqlite3.Connection): The label cache.
+
+    Returns:
+        None
+    """
+    global dhash_index
+
+    if dhash_index is not None:
+        return
+
+    dhash_index = {}
+    for dhash, key in label_cache.execute("SELECT dhash, key FROM dhashes"):
+        add_dhash(int(dhash, 16), key)
+
+def forget_dhashes(label_cache, key):
+    """
+    Remove the perceptual hashes of evicted labels from the label cache and from `dhash_index`.
+
+    Args:
+        label_cache (sqlite3.Connection): The label cache.
+        key (str): The cache key of the evicted labels.
+
+    Returns:
+        None
+    """
+    dhashes = label_cache.execute("SELECT dhash FROM dhashes WHERE key = ?", (key,)).fetchall()
+    if not dhashes:
+        return
+
+    label_cache.execute("DELETE FROM dhashes WHERE key = ?", (key,))
+    if dhash_index is None:
+        return
+
+    for (dhash,) in dhashes:
+        dhash = int(dhash, 16)
+        for band in get_dhash_bands(dhash, int(google_vision_phash_distance) + 1):
+            dhash_index.get(band, {}).pop(dhash, None)
+
+def find_similar_labels(label_cache, dhash):
+    """
+    Find the labels of an already labelled image whose perceptual hash is within
+    `google_vision_phash_distance` bits of the given hash.
+
+    Args:
+        label_cache (sqlite3.Connection): The label cache.
+        dhash (int): The hash of the image.
+
+    Returns:
+        list: A list of tuples containing label descriptions and scores, or None if
+            there is no similar image.
+    """
+    distance = int(google_vision_phash_distance)
+    candidates = set()
+    for band in get_dhash_bands(dhash, distance + 1):
+        candidates.update(dhash_index.get(band, {}).items())
+
+    # Prefer the most similar image, its labels may have been evicted from the cache
+    for difference, key in sorted((bin(dhash ^ other).count("1"), key) for other, key in candidates):
+        if difference > distance:
+            break
+        labels = get_cached_labels(label_cache, key)
+        if labels is not None:
+            return labels
+
+    return None
+
+def annotate_images(images):
+    """
+    Get the labels of several images, from the label cache or from the Google Vision API.
+
+    Images that are not cached are annotated in batched, parallel requests. If a request fails,
+    the labels of the other requests are still cached before the error is raised. Images the
+    Google Vision API returned an error for are not cached, so they are sent again next time.
+
+    Args:
+        images (list): The images, see fetch_image.
+
+    Returns:
+        list: A list with a list of tuples containing label descriptions and scores per image,
+            or None for an image that failed, in the order of the images.
+
+    Raises:
+        Exception: The error of the first failed request.
+    """
+    label_cache = open_label_cache()
+
+    image_labels = [None] * len(images)
+    keys = [None] * len(images)
+    if label_cache:
+        cache_bytes = get_label_cache_bytes(label_cache)
+        for index, image in enumerate(images):
+            keys[index] = get_label_cache_key(image)
+            image_labels[index] = get_cached_labels(label_cache, keys[index])
+
+    # Reuse the labels of similar images
+    use_dhash = label_cache and google_vision_phash_distance
+    if use_dhash:
+        load_dhash_index(label_cache)
+        similar = 0
+        for index, image in enumerate(images):
+            if image_labels[index] is None and image["dhash"] is not None:
+                image_labels[index] = find_similar_labels(label_cache, image["dhash"])
+                similar += image_labels[index] is not None
+        if similar:
+            print(f"Reused the labels of similar images for {similar} images")
+
+    missing = [index for index, labels in enumerate(image_labels) if labels is None]
+    if len(missing) < len(images):
+        print(f"Found labels of {len(images) - len(missing)} images in the cache")
+
+    # Annotate the batches in parallel
+    batches = plan_vision_batches([images[index] for index in missing])
+    print(f"Processing {len(missing)} images in {len(batches)} requests...")
+    with ThreadPoolExecutor(max_workers=vision_concurrency) as executor:
+        futures = [executor.submit(google_vision_process_batch, batch) for batch in batches]
+
+    # Keep the labels of the successful batches, even if another batch failed
+    error = None
+    batch_start = 0
+    for batch, future in zip(batches, futures):
+        batch_missing = missing[batch_start:batch_start + len(batch)]
+        batch_start += len(batch)
+        try:
+            batch_labels = future.result()
+        except Exception as e:
+            error = error or e
+            continue
+
+        for index, labels in zip(batch_missing, batch_labels):
+            image_labels[index] = labels
+            if labels is None:
+                continue
+            if label_cache:
+                cache_bytes = add_cached_labels(label_cache, keys[index], labels, cache_bytes)
+            if use_dhash and images[index]["dhash"] is not None:
+                label_cache.execute(
+                    "INSERT OR REPLACE INTO dhashes VALUES (?, ?)",
+                    (f"{images[index]['dhash']:016x}", keys[index]),
+                )
+                add_dhash(images[index]["dhash"], keys[index])
+
+    # Commit the lookups and the added labels at once
+    if label_cache:
+        label_cache.commit()
+        label_cache.close()
+
+    if error:
+        raise error
+
+    return image_labels
+
+def check_label_index_table(index_table, labelled_table):
+    """
+    Check if the label index table exists, and create it if it does not.
+
+    The table has the columns 'Name' (the label) and 'Rows' (links to the labelled rows).
+    The scores stay in the labels column of the labelled rows, so a label row does not grow
+    with the number of its rows and only its links are added or removed.
+
+    Args:
+        index_table (str): Name of the label index table.
+        labelled_table (str): Name of the table with the labelled rows.
+
+    Returns:
+        None
+    """
+    base_metadata = base.get_metadata()
+    if any(table["name"] == index_table for table in base_metadata["tables"]):
+        return
+
+    base.add_table(index_table)
+    base.insert_column(
+        index_table,
+        "Rows",
+        ColumnTypes.LINK,
+        column_data={"table": index_table, "other_table": labelled_table},
+    )
+
+def get_linked_row_ids(links):
+    """
+    Get the IDs of the linked rows from the value of a link column.
+
+    Args:
+        links (list): The value of the link column, linked row IDs or dictionaries
+            with a 'row_id' key, or None.
+
+    Returns:
+        set: The IDs of the linked rows.
+    """
+    return {link["row_id"] if isinstance(link, dict) else link for link in links or []}
+
+def load_label_index(index_table):
+    """
+    Load the label index table.
+
+    Args:
+        index_table (str): Name of the label index table.
+
+    Returns:
+        dict: A dictionary mapping labels to their index row IDs and the IDs of their rows.
+    """
+    label_index = {}
+    start = 0
+    while True:
+        rows = base.list_rows(index_table, start=start, limit=rows_page_size)
+        for index_row in rows:
+            label_index[index_row["Name"]] = {
+                "_id": index_row["_id"],
+                "rows": get_linked_row_ids(index_row.get("Rows")),
+            }
+        start += len(rows)
+        if len(rows) < rows_page_size:
+            break
+
+    return label_index
+
+class LabelIndex:
+    """
+    The label index table, loaded once per run and updated in memory.
+
+    update collects the changes of newly labelled rows, and flush writes each changed label
+    once, however many rows of it changed since the last flush. Labels a row no longer has
+    are removed from the index.
+    """
+
+    def __init__(self, index_table, labelled_table):
+        """
+        Args:
+            index_table (str): Name of the label index table.
+            labelled_table (str): Name of the table with the labelled rows.
+        """
+        check_label_index_table(index_table, labelled_table)
+
+        self.index_table = index_table
+        self.labelled_table = labelled_table
+        self.entries = load_label_index(index_table)
+        self.changed_labels = set()
+
+        # The labels of each row, to find the labels a row no longer has
+        self.row_labels = {}
+        for label_description, entry in self.entries.items():
+            for row_id in entry["rows"]:
+                self.row_labels.setdefault(row_id, set()).add(label_description)
+
+    def update(self, labelled_rows):
+        """
+        Collect the labels of newly labelled rows.
+
+        Args:
+            labelled_rows (list): A list of (row ID, labels) tuples, the labels being a list
+                of tuples containing label descriptions and scores.
+
+        Returns:
+            None
+        """
+        for row_id, labels in labelled_rows:
+            row_labels = {label_description for label_description, _ in labels}
+
+            for label_description in self.row_labels.get(row_id, set()) - row_labels:
+                self.entries[label_description]["rows"].discard(row_id)
+                self.changed_labels.add(label_description)
+
+            for label_description in row_labels:
+                entry = self.entries.setdefault(label_description, {"_id": None, "rows": set()})
+                if row_id not in entry["rows"]:
+                    entry["rows"].add(row_id)
+                    self.changed_labels.add(label_description)
+
+            self.row_labels[row_id] = row_labels
+
+    def flush(self):
+        """
+        Write the labels that changed since the last flush to the label index table.
+
+        Returns:
+            None
+        """
+        if not self.changed_labels:
+            return
+
+        changed_labels = sorted(self.changed_labels)
+        new_labels = [
+            label_description
+            for label_description in changed_labels
+            if self.entries[label_description]["_id"] is None
+        ]
+
+        for i in range(0, len(new_labels), batch_update_size):
+            chunk = new_labels[i:i + batch_update_size]
+            result = base.batch_append_rows(
+                self.index_table, [{"Name": label_description} for label_description in chunk]
+            )
+            # The IDs of the appended rows are returned in the order of the rows
+            for label_description, appended_row in zip(chunk, result["row_ids"]):
+                self.entries[label_description]["_id"] = appended_row["_id"]
+
+        # Link each changed label to all of its rows
+        link_id = base.get_column_link_id(self.index_table, "Rows")
+        changed_entries = [self.entries[label_description] for label_description in changed_labels]
+        for i in range(0, len(changed_entries), batch_update_size):
+            chunk = changed_entries[i:i + batch_update_size]
+            base.batch_update_links(
+                link_id,
+                self.index_table,
+                self.labelled_table,
+                [entry["_id"] for entry in chunk],
+                {entry["_id"]: sorted(entry["rows"]) for entry in chunk},
+            )
+
+        print(f"Updated {len(changed_labels)} labels in the label index")
+        self.changed_labels.clear()
+
+def open_label_index(labelled_table):
+    """
+    Open the label index, if the 'google_vision_label_index_table' setting is set.
+
+    Args:
+        labelled_table (str): Name of the table with the labelled rows.
+
+    Returns:
+        LabelIndex: The label index, or None if the label index is disabled.
+    """
+    if not google_vision_label_index_table:
+        return None
+
+    return LabelIndex(google_vision_label_index_table, labelled_table)
+
+def parse_labels(value):
+    """
+    Parse the labels that were written to the 'Google Vision API Labels' column.
+
+    Args:
+        value (str): The value of the column, or None.
+
+    Returns:
+        list: A list of tuples containing label descriptions and scores, empty if the
+            value is empty or cannot be parsed.
+    """
+    if not value:
+        return []
+
+    try:
+        return [
+            (label_description, label_score)
+            for label_description, label_score in ast.literal_eval(value)
+        ]
+    except (ValueError, TypeError, SyntaxError):
+        return []
+
+def query_label_index(index_table, label_descriptions):
+    """
+    Look up the index row IDs of some labels in the label index table.
+
+    Args:
+        index_table (str): Name of the label index table.
+        label_descriptions (set): The labels to look up.
+
+    Returns:
+        dict: A dictionary mapping the found labels to their index row IDs.
+    """
+    # Quote the labels as SQL strings, escaping quotes and backslashes
+    names = ", ".join(
+        json.dumps(label_description, ensure_ascii=False) for label_description in label_descriptions
+    )
+    index_rows = base.query(
+        f"SELECT _id, Name FROM `{index_table}` "
+        f"WHERE Name IN ({names}) LIMIT {len(label_descriptions)}"
+    )
+
+    return {index_row["Name"]: index_row["_id"] for index_row in index_rows}
+
+def update_label_index_row(labelled_table, row_id, previous_labels, labels):
+    """
+    Update the label index table for one row, if the 'google_vision_label_index_table' setting
+    is set.
+
+    Unlike LabelIndex, only the labels the row had or has now are looked up, and only the
+    links of the row are added or removed, so the update does not grow with the index.
+
+    Args:
+        labelled_table (str): Name of the table with the labelled row.
+        row_id (str): The ID of the row.
+        previous_labels (list): The labels the row had before, see parse_labels.
+        labels (list): The new labels of the row.
+
+    Returns:
+        None
+    """
+    if not google_vision_label_index_table:
+        return
+
+    index_table = google_vision_label_index_table
+    check_label_index_table(index_table, labelled_table)
+
+    row_labels = {label_description for label_description, _ in labels}
+    removed_labels = {label_description for label_description, _ in previous_labels} - row_labels
+    if not row_labels and not removed_labels:
+        return
+
+    index_row_ids = query_label_index(index_table, row_labels | removed_labels)
+
+    new_labels = sorted(row_labels - set(index_row_ids))
+    if new_labels:
+        result = base.batch_append_rows(
+            index_table, [{"Name": label_description} for label_description in new_labels]
+        )
+        # The IDs of the appended rows are returned in the order of the rows
+        for label_description, appended_row in zip(new_labels, result["row_ids"]):
+            index_row_ids[label_description] = appended_row["_id"]
+
+    # Linking is idempotent, so the labels the row kept are linked again in case the row
+    # was labelled before the label index was enabled
+    link_id = base.get_column_link_id(index_table, "Rows")
+    for label_description in sorted(row_labels):
+        base.add_link(link_id, index_table, labelled_table, index_row_ids[label_description], row_id)
+    for label_description in sorted(removed_labels & set(index_row_ids)):
+        base.remove_link(link_id, index_table, labelled_table, index_row_ids[label_description], row_id)
+
+    print(f"Updated {len(row_labels) + len(removed_labels)} labels in the label index")
+
+def fetch_image_or_none(image_url):
+    """
+    Fetch an image like fetch_image, but return None instead of failing.
+
+    Args:
+        image_url (str): URL of the image to fetch.
+
+    Returns:
+        dict: The image, see fetch_image, or None if it could not be fetched.
+    """
+    try:
+        return fetch_image(image_url)
+    except Exception as e:
+        print(f"Failed to fetch {image_url}: {e}")
+        return None
+
+def split_row_groups(rows):
+    """
+    Split rows into groups of about `backfill_group_images` images.
+
+    A row is never split, so a row with more images gets a group of its own.
+
+    Args:
+        rows (list): The rows, each with at least one image.
+
+    Returns:
+        list: A list of groups, each a list of rows.
+    """
+    groups = []
+    group = []
+    group_images = 0
+    for backfill_row in rows:
+        if group and group_images + len(backfill_row[image_column]) > backfill_group_images:
+            groups.append(group)
+            group = []
+            group_images = 0
+        group.append(backfill_row)
+        group_images += len(backfill_row[image_column])
+
+    if group:
+        groups.append(group)
+
+    return groups
+
+def produce_backfill_pages(groups, backfill_table, backfill_view):
+    """
+    Read the rows of a table page by page and fetch the images of the rows without labels.
+
+    This is the producer of the backfill pipeline. It runs in its own thread and puts
+    (number of rows read, rows, images per row) tuples into the queue, one per group of rows
+    (see split_row_groups), followed by None when all rows were read, or by the exception if
+    reading the rows failed. The number of rows read is only set in the last tuple of a page.
+    The queue is bounded, so the producer waits while the consumer is busy with earlier groups
+    and only a few groups of images are held in memory, however large the pages are.
+
+    Args:
+        groups (queue.Queue): The queue that receives the groups.
+        backfill_table (str): The name of the table.
+        backfill_view (str): The name of a view that limits the rows, or None.
+
+    Returns:
+        None
+    """
+    start = 0
+    end = None
+    try:
+        with ThreadPoolExecutor(max_workers=vision_concurrency) as executor:
+            while True:
+                rows = base.list_rows(
+                    backfill_table, view_name=backfill_view, start=start, limit=rows_page_size
+                )
+                if not rows:
+                    break
+                start += len(rows)
+
+                # Skip the rows that are labelled already or have no images
+                rows_to_label = [
+                    backfill_row
+                    for backfill_row in rows
+                    if backfill_row.get(image_column)
+                    and not backfill_row.get(google_vision_label_column)
+                ]
+
+                # Fetch the images of all rows of a group at once, then regroup them by row
+                row_groups = split_row_groups(rows_to_label) or [[]]
+                for group_number, group in enumerate(row_groups, 1):
+                    row_image_urls = [backfill_row[image_column] for backfill_row in group]
+                    group_images = executor.map(
+                        fetch_image_or_none,
+                        [image_url for image_urls in row_image_urls for image_url in image_urls],
+                    )
+                    images = [[next(group_images) for _ in image_urls] for image_urls in row_image_urls]
+                    page_rows = len(rows) if group_number == len(row_groups) else 0
+                    groups.put((page_rows, group, images))
+
+                if len(rows) < rows_page_size:
+                    break
+    except Exception as e:
+        # Hand the error to the consumer, which raises it again
+        end = e
+    finally:
+        groups.put(end)
+
+def backfill(backfill_table, backfill_view=None):
+    """
+    Label all rows of a table or view that have images but no labels yet.
+
+    A producer thread reads the rows and fetches their images, while this function annotates
+    the images of each group of rows (using the label cache and batched, parallel requests limited
+    by `vision_rate_limiter`) and writes the labels back with batch updates. The label index
+    is written every `label_index_flush_pages` pages and at the end.
+
+    Args:
+        backfill_table (str): The name of the table.
+        backfill_view (str, optional): The name of a view that limits the rows.
+
+    Returns:
+        None
+
+    Raises:
+        Exception: The error of the producer, if reading the rows failed.
+    """
+    label_index = open_label_index(backfill_table)
+
+    groups = queue.Queue(maxsize=2)
+    producer = threading.Thread(
+        target=produce_backfill_pages, args=(groups, backfill_table, backfill_view), daemon=True
+    )
+    producer.start()
+
+    read_pages = 0
+    read_rows = 0
+    labelled_rows = 0
+    errors = 0
+    saved_bytes = 0
+    started_at = time.monotonic()
+
+    while True:
+        group = groups.get()
+        if group is None or isinstance(group, Exception):
+            break
+        page_rows, rows_to_label, images = group
+
+        # Rows with an image that could not be fetched are left for the next run
+        complete = [
+            (backfill_row, row_images)
+            for backfill_row, row_images in zip(rows_to_label, images)
+            if None not in row_images
+        ]
+        errors += len(rows_to_label) - len(complete)
+
+        # Annotate the images of all rows of the group at once. If a request still fails after
+        # its retries, the rows of the group are left for the next run, like rows whose images
+        # could not be fetched. The labels of the successful requests are cached already.
+        group_images = [image for _, row_images in complete for image in row_images]
+        saved_bytes += sum(image["saved_bytes"] for image in group_images)
+        try:
+            group_labels = iter(annotate_images(group_images))
+        except Exception as e:
+            print(f"Failed to label {len(complete)} rows: {e}")
+            errors += len(complete)
+            complete = []
+
+        updates = []
+        indexed_rows = []
+        for backfill_row, row_images in complete:
+            row_labels = [next(group_labels) for _ in row_images]
+
+            # Rows with an image that Vision failed to annotate are left for the next run
+            if None in row_labels:
+                errors += 1
+                continue
+
+            google_vision_labels = []
+            for labels in row_labels:
+                google_vision_labels.extend(labels)
+            row_data = {google_vision_label_column: str(google_vision_labels)}
+            updates.append({"row_id": backfill_row["_id"], "row": row_data})
+            indexed_rows.append((backfill_row["_id"], google_vision_labels))
+
+        for i in range(0, len(updates), batch_update_size):
+            base.batch_update_rows(backfill_table, updates[i:i + batch_update_size])
+
+        labelled_rows += len(updates)
+        if label_index:
+            label_index.update(indexed_rows)
+
+        # Report the progress and write the label index at the end of each page
+        if not page_rows:
+            continue
+
+        read_pages += 1
+        if label_index and read_pages % label_index_flush_pages == 0:
+            label_index.flush()
+
+        read_rows += page_rows
+        elapsed = max(time.monotonic() - started_at, 0.001)
+        print(
+            f"Read {read_rows} rows: {labelled_rows} labelled, {errors} failed "
+            f"({read_rows / elapsed:.1f} rows/s, {labelled_rows / elapsed:.1f} labelled rows/s), "
+            f"downscaling saved {saved_bytes} bytes"
+        )
+
+    producer.join()
+
+    if label_index:
+        label_index.flush()
+
+    if isinstance(group, Exception):
+        raise group
 
 def main():
     """
     Main function for processing image labels using the Google Vision API.
 
     This function is the entry point of the script.
-    It retrieves the Base64-encoded contents of images from the 'Image' column in the current row,
-    processes the images using the Google Vision API to obtain labels,
+    It fetches the images from the 'Image' column in the current row,
+    looks up their labels in the label cache or processes them in batched, parallel requests
+    to the Google Vision API,
     and updates the 'Google Vision API Labels' column in the current row with the obtained labels.
 
     Returns:
         None
     """
-    encoded_images = get_images()
+    images = get_images()
+
+    image_labels = annotate_images(images)
+
+    # Leave the row unlabelled, so it is labelled again when the automation runs next time
+    failed = sum(labels is None for labels in image_labels)
+    if failed:
+        raise ValueError(f"Label detection failed for {failed} of {len(image_labels)} images.")
 
     google_vision_labels = []
 
-    for counter, encoded_image in enumerate(encoded_images, 1):
-        print(f"Processing image {counter}/{len(encoded_images)}...")
-        google_vision_labels.extend(google_vision_process(encoded_image))
+    for labels in image_labels:
+        google_vision_labels.extend(labels)
 
     row_data = {
         google_vision_label_column: str(google_vision_labels)
@@ -250,6 +1510,10 @@ def main():
 
     base.update_row(table_name, row["_id"], row_data)
 
+    # The current row still holds the labels from before this run
+    previous_labels = parse_labels(row.get(google_vision_label_column))
+    update_label_index_row(table_name, row["_id"], previous_labels, google_vision_labels)
+
 if __name__ == "__main__":
     # Check if the config table exists
     check_config_table(config_table)
@@ -258,10 +1522,21 @@ if __name__ == "__main__":
     config_values = get_config_values(config_table)
     locals().update(config_values)
 
+    # Write the buffered metrics when the script ends
+    atexit.register(flush_telemetry)
+
     # Set up Google Cloud credentials
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = google_vision_application_credentials
 
+    vision_concurrency = int(config_values.get("google_vision_concurrency", vision_concurrency))
+    if google_vision_requests_per_minute:
+        requests_per_second = int(google_vision_requests_per_minute) / 60
+        vision_rate_limiter = TokenBucket(requests_per_second, vision_concurrency)
+
     # Execute the main function
-    main()
+    if google_vision_mode == "backfill":
+        backfill(google_vision_backfill_table, google_vision_backfill_view)
+    else:
+        main()
 
 exit()
@@ -1,20 +1,34 @@
 """
 This script is used to configure and interact with Seatable API for ChatGPT.
 It requires the `seatable-api` package to be installed.
+
+Optional settings in the "_settings" table:
+- openai_timeout: the timeout of OpenAI API requests in seconds (default: 120).
+- openai_max_retries: how often throttled or failed OpenAI API requests are retried (default: 5).
+- telemetry_file: path of a JSON lines file that receives the metrics of every OpenAI and Google Vision API
+  call: latency, time to first byte, request and response bytes, prompt and completion tokens, model and status.
+- telemetry_table: name of a table that receives the same metrics when the script ends. It is created if it
+  does not exist.
 """
 
 __author__ = "Vitali Quiering"
-__version__ = "1.0.0-alpha"
+__version__ = "1.2.0-alpha"
 
+import atexit
 import base64
 import datetime
+import email.utils
 import json
 import os
 import random
 import requests
 import string
+import threading
+import time
 import urllib.parse
+from requests.adapters import HTTPAdapter
 from seatable_api import Base, context
+from seatable_api.constants import ColumnTypes
 
 # Configuration variables
 config_table = "_settings"
@@ -23,6 +37,34 @@ google_vision_labels_column = "Google Vision API Labels"
 chatgpt_dalle_prompt_column = "Image Prompt for DALL-E"
 chatgpt_output_caption_column = "ChatGPT Generated Description"
 
+# Defaults of the optional settings
+openai_timeout = 120
+openai_max_retries = 5
+
+# Pooled connections to the OpenAI API, kept alive between requests
+openai_retry_status_codes = (429, 500, 502, 503, 504)
+openai_session = requests.Session()
+openai_session.mount("https://", HTTPAdapter(pool_maxsize=16))
+
+# Metrics of the OpenAI and Google Vision API calls, see record_api_call
+telemetry_file = None
+telemetry_table = None
+telemetry_columns = {
+    "Time": ColumnTypes.TEXT,
+    "Service": ColumnTypes.TEXT,
+    "Endpoint": ColumnTypes.TEXT,
+    "Model": ColumnTypes.TEXT,
+    "Status": ColumnTypes.TEXT,
+    "Latency ms": ColumnTypes.NUMBER,
+    "TTFB ms": ColumnTypes.NUMBER,
+    "Request bytes": ColumnTypes.NUMBER,
+    "Response bytes": ColumnTypes.NUMBER,
+    "Prompt tokens": ColumnTypes.NUMBER,
+    "Completion tokens": ColumnTypes.NUMBER,
+}
+telemetry_rows = []
+telemetry_lock = threading.Lock()
+
 # Retrieve server URL and API token from the context
 server_url = context.server_url
 api_token = context.api_token
@@ -125,35 +167,185 @@ def call_chatgpt_for_caption(dalle_prompt, google_vision_labels):
 
     return generated_text
 
-import requests
+def check_telemetry_table(telemetry_table):
+    """
+    Check if the telemetry table exists, and create it with the metric columns if it does not.
 
-import requests
+    Args:
+        telemetry_table (str): Name of the telemetry table.
 
-def call_chatgpt(data):
+    Returns:
+        None
     """
-    Call the ChatGPT API to generate a response based on the provided input.
+    base_metadata = base.get_metadata()
+    if any(table["name"] == telemetry_table for table in base_metadata["tables"]):
+        return
+
+    base.add_table(telemetry_table)
+    for column, column_type in telemetry_columns.items():
+        base.insert_column(telemetry_table, column, column_type)
+
+
+def record_api_call(service, endpoint, model, started_at, response=None, error=None):
+    """
+    Record the metrics of an API call, if the 'telemetry_file' or 'telemetry_table' setting is set.
+
+    The metrics are appended to the JSON lines file right away and buffered for the telemetry
+    table, which is written by flush_telemetry when the script exits.
 
     Args:
-        chatgpt_role (str): The role for the AI in the conversation.
-        chatgpt_vision_labels (str): Google Vision labels for the input.
-        chatgpt_additional_notes (str): Additional notes for the AI.
+        service (str): The called service, e.g. "openai".
+        endpoint (str): The called endpoint, e.g. "chat/completions".
+        model (str): The requested model, or None.
+        started_at (float): The time.monotonic() value before the request was sent.
+        response (requests.Response, optional): The response, if one was received.
+        error (Exception, optional): The error, if no response was received.
 
     Returns:
-        The generated text response from ChatGPT.
+        None
+    """
+    if not telemetry_file and not telemetry_table:
+        return
+
+    usage = {}
+    if response is not None:
+        try:
+            usage = response.json().get("usage") or {}
+        except (ValueError, AttributeError):
+            pass
+
+    metrics = {
+        "Time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "Service": service,
+        "Endpoint": endpoint,
+        "Model": model,
+        "Status": str(response.status_code) if response is not None else type(error).__name__,
+        "Latency ms": round((time.monotonic() - started_at) * 1000),
+        # requests measures the time until the response headers arrived
+        "TTFB ms": round(response.elapsed.total_seconds() * 1000) if response is not None else None,
+        "Request bytes": len(response.request.body or b"") if response is not None else None,
+        "Response bytes": len(response.content) if response is not None else None,
+        "Prompt tokens": usage.get("prompt_tokens"),
+        "Completion tokens": usage.get("completion_tokens"),
+    }
+
+    with telemetry_lock:
+        if telemetry_file:
+            with open(telemetry_file, "a") as f:
+                f.write(json.dumps(metrics) + "\n")
+        if telemetry_table:
+            telemetry_rows.append(metrics)
+
+
+def flush_telemetry():
+    """
+    Write the buffered metrics to the telemetry table.
+
+    Returns:
+        None
+    """
+    with telemetry_lock:
+        rows = telemetry_rows[:]
+        del telemetry_rows[:]
+
+    if not rows:
+        return
+
+    check_telemetry_table(telemetry_table)
+    for i in range(0, len(rows), 1000):
+        base.batch_append_rows(telemetry_table, rows[i:i + 1000])
+
+
+def parse_retry_after(response):
+    """
+    Get the number of seconds to wait from the Retry-After header of a response.
+
+    Args:
+        response (requests.Response): The response.
+
+    Returns:
+        float: The number of seconds, or None if the header is missing or invalid.
     """
-    url = "https://api.openai.com/v1/chat/completions"
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def openai_request(openai_api_key, path, data):
+    """
+    Send a request to the OpenAI API over the pooled session.
+
+    Throttled (429) and failed (5xx) requests, connection errors and timeouts are retried
+    up to `openai_max_retries` times with exponential backoff, honoring Retry-After.
+
+    Args:
+        openai_api_key (str): The OpenAI API key.
+        path (str): The path of the endpoint, e.g. "chat/completions".
+        data (dict): The JSON body of the request.
+
+    Returns:
+        dict: The JSON response.
+
+    Raises:
+        requests.RequestException: If the request still fails after the retries.
+    """
+    url = f"https://api.openai.com/v1/{path}"
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {openai_api_key}"
     }
+    max_retries = int(openai_max_retries)
+
+    for attempt in range(max_retries + 1):
+        retry_after = None
+        started_at = time.monotonic()
+        try:
+            response = openai_session.post(
+                url, headers=headers, json=data, timeout=float(openai_timeout)
+            )
+            record_api_call("openai", path, data.get("model"), started_at, response)
+            if response.status_code not in openai_retry_status_codes or attempt == max_retries:
+                response.raise_for_status()
+                return response.json()
+            retry_after = parse_retry_after(response)
+            error = f"status code {response.status_code}"
+        except (requests.ConnectionError, requests.Timeout) as e:
+            record_api_call("openai", path, data.get("model"), started_at, error=e)
+            if attempt == max_retries:
+                raise
+            error = e
+
+        # Exponential backoff with jitter, unless the API tells us how long to wait
+        delay = retry_after if retry_after is not None else 2 ** attempt + random.random()
+        print(f"OpenAI request failed ({error}), retrying in {delay:.1f}s...")
+        time.sleep(delay)
 
-    try:
-        response = requests.post(url, headers=headers, json=data)
-        generated_text = response.json()["choices"][0]["message"]["content"]
-        return generated_text
-    except Exception as e:
-        print(f"Error: {e}")
-        return None
+
+def call_chatgpt(data):
+    """
+    Call the ChatGPT API to generate a response based on the provided input.
+
+    Args:
+        data (dict): The request body with the messages and the sampling parameters.
+
+    Returns:
+        The generated text response from ChatGPT.
+    """
+    response_json = openai_request(openai_api_key, "chat/completions", data)
+    generated_text = response_json["choices"][0]["message"]["content"]
+    return generated_text
 
 
 def generate_dalle_image(dalle_prompt):
@@ -161,7 +353,8 @@ def generate_dalle_image(dalle_prompt):
     # Generate the image using the call_dalle function
     generated_image_url = get_dalle_url(dalle_prompt)
 
-    generated_image = requests.get(generated_image_url)
+    generated_image = openai_session.get(generated_image_url, timeout=float(openai_timeout))
+    generated_image.raise_for_status()
 
     # Generate a random 8-character string
     random_str = ''.join(random.choices(string.ascii_letters + string.digits, k=8))
@@ -185,18 +378,13 @@ def get_dalle_url(dalle_prompt):
     Returns:
         str: The URL of the generated image.
     """
-    url = "https://api.openai.com/v1/images/generations"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {openai_api_key}"
-    }
     data = {
         "prompt": f"{dalle_prompt}",
         "size": "1024x1024",
         "n": 1
     }
-    response = requests.post(url, headers=headers, json=data)
-    generated_image_url = response.json()["data"][0]["url"]
+    response_json = openai_request(openai_api_key, "images/generations", data)
+    generated_image_url = response_json["data"][0]["url"]
     return generated_image_url
 
 
@@ -204,8 +392,8 @@ def download_image(image_url):
     """
     Download an image from the specified URL and return its Base64-encoded content.
 
-    This function downloads an image from the given URL and saves it to the local file system.
-    It then reads the content of the image file, encodes it as Base64, and returns the Base64-encoded content.
+    This function downloads the image into memory, without writing it to the local file system,
+    and returns its Base64-encoded content.
 
     Args:
         image_url (str): URL of the image to download.
@@ -213,18 +401,16 @@ def download_image(image_url):
     Returns:
         str: Base64-encoded content of the downloaded image.
     """
-    # Extract the filename from the image URL
-    image_path = os.path.basename(urllib.parse.urlparse(image_url).path)
-
-    # Download the image file
-    base.download_file(image_url, image_path)
+    # Same path handling as base.download_file, but without writing to disk
+    path = urllib.parse.unquote(image_url.split(str(base.dtable_uuid))[-1].strip("/"))
+    download_link = base.get_file_download_link(path)
 
-    # Read the image file
-    with open(image_path, "rb") as image_file:
-        image_content = image_file.read()
+    response = requests.get(download_link)
+    if response.status_code != 200:
+        raise ValueError(f"Failed to download {image_url}. Status code: {response.status_code}")
 
     # Encode the image content as Base64
-    encoded_image_content = base64.b64encode(image_content).decode("utf-8")
+    encoded_image_content = base64.b64encode(response.content).decode("ascii")
 
     return encoded_image_content
 
@@ -256,7 +442,13 @@ def google_vision_process(encoded_image):
 
     # Make the API request
     api_url = "https://vision.googleapis.com/v1/images:annotate?key=" + google_vision_api_key
-    response = requests.post(api_url, json=google_vision_payload)
+    started_at = time.monotonic()
+    try:
+        response = requests.post(api_url, json=google_vision_payload)
+    except requests.RequestException as e:
+        record_api_call("google_vision", "images:annotate", None, started_at, error=e)
+        raise
+    record_api_call("google_vision", "images:annotate", None, started_at, response)
 
     # Parse the response
     response_json = response.json()
@@ -318,6 +510,9 @@ if __name__ == "__main__":
     config_values = get_config_values(config_table)
     locals().update(config_values)
 
+    # Write the buffered metrics when the script ends
+    atexit.register(flush_telemetry)
+
     # Call the main function
     main()
 
@@ -1,5 +1,7 @@
 """
-This script downloads file attachments from a SeaTable table row, uploads them to Seafile, and updates the table row with the new URLs.
+This script copies file attachments from a SeaTable table row to Seafile, and updates the table row with the new URLs.
+It can also migrate all rows of a table or view in one run.
+The attachments are streamed from SeaTable to Seafile in chunks, nothing is written to the local disk.
 
 Prerequisites:
 - A SeaTable base and a Seafile library with valid credentials.
@@ -16,24 +18,65 @@ Usage:
    - seafile_library_id: the ID of your Seafile library.
    - seafile_library_api_token: the Seafile library API token that you used for connecting to Seafile.
    - seafile_dir: the parent directory of the uploaded files in your Seafile library.
+   - seafile_concurrency: the number of attachments that are copied at the same time (default: 4 in new
+     settings tables, 1 if the setting is missing).
+   - seafile_dir_cache_file: optional path of a file that remembers existing Seafile directories across runs.
+   - seafile_upload_link_ttl: the number of seconds an upload link is reused (default: 300, 0 disables reuse).
+   - migration_mode: 'row' to migrate the current row (default), 'table' to migrate all rows of a table.
+   - migration_table: the table that is migrated in 'table' mode (default: the current table).
+   - migration_view: optional view that limits the rows that are migrated in 'table' mode.
+     Do not filter the view on the file columns, the rows are paged by offset.
+   - dedup_index_file: optional path of a SQLite file that maps file contents to uploaded files.
+     Attachments with the same content are uploaded once and share the Seafile URL.
+   - migration_journal_file: optional path of a file that records every copied attachment and,
+     in 'table' mode, the progress of the run. A run that was interrupted continues where it stopped.
+   - seafile_upload_batch_size: optional size in bytes up to which small attachments are grouped
+     and uploaded with one request (default: 0, disabled). Not used together with dedup_index_file
+     or seatable_asset_repo_id.
+   - seafile_upload_batch_files: the maximum number of attachments in one upload request (default: 20).
+   - seafile_chunked_upload_size: optional size in bytes from which attachments are uploaded in chunks
+     that are resumed after a failure (default: 0, disabled).
+   - seatable_asset_repo_id: optional ID of the Seafile library that stores the assets of your SeaTable base,
+     if SeaTable and your library live on the same Seafile server and your user can read it.
+     Attachments are then copied by Seafile itself, without passing through the script.
+   - seafile_request_timeout: the number of seconds to wait for Seafile or SeaTable to connect or send
+     data before a request fails (default: 60). A failed chunk of a chunked upload is then resumed.
 6. Run the script in an automation or via a button.
 
+Attachments that already point to Seafile are skipped, so the script can be run again safely.
+
 Note: Make sure that your settings are correct before running the script.
 """
 __author__ = "Vitali Quiering"
-__version__ = "1.0.1"
+__version__ = "1.10.0"
 
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
+import hashlib
+import json
 import os
 import random
+import sqlite3
 import string
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
 import requests
 from seatable_api import Base, context
 from seatable_api.constants import ColumnTypes
 
 # config
 config_table = "_settings"
+stream_chunk_size = 1024 * 1024
+spool_memory_size = 16 * 1024 * 1024
+upload_chunk_size = 8 * 1024 * 1024
+upload_retries = 5
+rows_page_size = 1000
+batch_update_size = 1000
 
 server_url = context.server_url
 api_token = context.api_token
@@ -45,6 +88,35 @@ base.auth()
 row = context.current_row
 table_name = context.current_table
 
+# Seafile directories that are known to exist, see remember_seafile_dir
+known_seafile_dirs = set()
+known_seafile_dirs_lock = threading.Lock()
+
+# Upload links by (library ID, directory), see get_cached_upload_url
+upload_links = {}
+upload_links_lock = threading.Lock()
+
+# Content hash index of uploaded files, see open_dedup_index
+dedup_index = None
+dedup_index_lock = threading.Lock()
+
+# Copied attachments and table checkpoints of earlier runs, see load_migration_journal
+journaled_urls = {}
+journaled_checkpoints = {}
+migration_journal_lock = threading.Lock()
+
+
+class SeafileDirNotFound(Exception):
+    """Raised when Seafile rejects an upload because the upload directory is missing."""
+
+
+class SeafileUploadLinkExpired(Exception):
+    """Raised when Seafile rejects an upload because the upload link is no longer valid."""
+
+
+class TransferInterrupted(Exception):
+    """Raised when a server fails with a 5xx status or a download ends early, so a retry may succeed."""
+
 
 def create_config_table(config_table):
     """
@@ -69,6 +141,19 @@ def create_config_table(config_table):
         {"Name": "seafile_library_id"},
         {"Name": "seafile_library_api_token"},
         {"Name": "seafile_dir", "value": ".seatable_uploads"},
+        {"Name": "seafile_concurrency", "value": "4"},
+        {"Name": "seafile_dir_cache_file"},
+        {"Name": "seafile_upload_link_ttl", "value": "300"},
+        {"Name": "migration_mode", "value": "row"},
+        {"Name": "migration_table"},
+        {"Name": "migration_view"},
+        {"Name": "dedup_index_file"},
+        {"Name": "migration_journal_file"},
+        {"Name": "seafile_upload_batch_size", "value": "0"},
+        {"Name": "seafile_upload_batch_files", "value": "20"},
+        {"Name": "seafile_chunked_upload_size", "value": "0"},
+        {"Name": "seatable_asset_repo_id"},
+        {"Name": "seafile_request_timeout", "value": "60"},
     ]
 
     # Batch append the default rows to the table
@@ -144,7 +229,7 @@ def get_upload_url(
     headers = {"Authorization": f"Token {seafile_api_token}"}
 
     # Send the request to the Seafile server
-    response = requests.get(url, headers=headers)
+    response = requests.get(url, headers=headers, timeout=seafile_request_timeout)
 
     # Check if the response was successful (HTTP status code 200)
     if response.status_code == 200:
@@ -156,6 +241,54 @@ def get_upload_url(
             f"Failed to get upload URL. Status code: {response.status_code}"
         )
 
+def get_cached_upload_url(seafile_upload_dir):
+    """
+    Get the URL for uploading files to a directory of the Seafile library, reusing earlier links.
+
+    A link is reused for `seafile_upload_link_ttl` seconds, so all files of a run share
+    a few links instead of requesting one per file.
+
+    Args:
+        seafile_upload_dir (str): The directory in the library to upload the files to.
+
+    Returns:
+        The URL for uploading files to the specified Seafile library and directory.
+    """
+    key = (seafile_library_id, normalize_seafile_dir(seafile_upload_dir))
+
+    with upload_links_lock:
+        url, expires_at = upload_links.get(key, (None, 0))
+    if time.monotonic() < expires_at:
+        return url
+
+    # Request the link without holding the lock, so the other uploads do not wait for it.
+    # Uploads that find an expired link at the same time may each request one.
+    url = get_upload_url(seafile_host, seafile_library_id, seafile_api_token, seafile_upload_dir)
+
+    with upload_links_lock:
+        upload_links[key] = (url, time.monotonic() + seafile_upload_link_ttl)
+
+    return url
+
+
+def forget_upload_url(seafile_upload_dir, url):
+    """
+    Drop a cached upload link that Seafile rejected.
+
+    Args:
+        seafile_upload_dir (str): The directory the link was requested for.
+        url (str): The rejected link. A newer link requested by another upload is kept.
+
+    Returns:
+        None
+    """
+    key = (seafile_library_id, normalize_seafile_dir(seafile_upload_dir))
+
+    with upload_links_lock:
+        if upload_links.get(key, (None, 0))[0] == url:
+            del upload_links[key]
+
+
 def check_seafile_dir(dir):
     """
     Check if a given directory exists in the Seafile library.
@@ -171,7 +304,113 @@ def check_seafile_dir(dir):
     url = f"{seafile_host}/api/v2.1/repos/{seafile_library_id}/dir/detail/?path={dir}"
     headers = {"Authorization": f"Token {seafile_api_token}"}
 
-    return requests.get(url, headers=headers)
+    return requests.get(url, headers=headers, timeout=seafile_request_timeout)
+
+
+def normalize_seafile_dir(dir):
+    """
+    Normalize a Seafile directory path, so that each directory has exactly one spelling in the cache.
+
+    Args:
+        dir (str): The directory path, with or without leading slash.
+
+    Returns:
+        str: The directory path with a single leading slash.
+    """
+    return "/" + dir.strip("/")
+
+
+def load_known_seafile_dirs():
+    """
+    Load the directories of the Seafile library that were seen in earlier runs.
+
+    The cache file is only used if the 'seafile_dir_cache_file' setting is set. It maps
+    library IDs to lists of directories, so one file can be shared by several libraries.
+
+    Returns:
+        None
+    """
+    if not seafile_dir_cache_file or not os.path.exists(seafile_dir_cache_file):
+        return
+
+    try:
+        with open(seafile_dir_cache_file) as cache_file:
+            cached_dirs = json.load(cache_file).get(seafile_library_id, [])
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable directory cache {seafile_dir_cache_file}: {e}")
+        return
+
+    known_seafile_dirs.update(cached_dirs)
+
+
+def save_known_seafile_dirs():
+    """
+    Save the directories of the Seafile library that are known to exist to the cache file.
+
+    Must be called with known_seafile_dirs_lock held.
+
+    Returns:
+        None
+    """
+    if not seafile_dir_cache_file:
+        return
+
+    cache = {}
+    if os.path.exists(seafile_dir_cache_file):
+        try:
+            with open(seafile_dir_cache_file) as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            cache = {}
+
+    cache[seafile_library_id] = sorted(known_seafile_dirs)
+
+    with open(seafile_dir_cache_file, "w") as cache_file:
+        json.dump(cache, cache_file)
+
+
+def remember_seafile_dir(dir):
+    """
+    Remember that a directory and all its parents exist in the Seafile library.
+
+    Args:
+        dir (str): The directory that exists.
+
+    Returns:
+        None
+    """
+    dirs = normalize_seafile_dir(dir).strip("/").split("/")
+    paths = {"/" + "/".join(dirs[:i]) for i in range(1, len(dirs) + 1)}
+
+    with known_seafile_dirs_lock:
+        if paths <= known_seafile_dirs:
+            return
+        known_seafile_dirs.update(paths)
+        save_known_seafile_dirs()
+
+
+def forget_seafile_dir(dir):
+    """
+    Forget a directory that turned out to be missing, e.g. because it was deleted in Seafile.
+
+    Args:
+        dir (str): The directory that is missing.
+
+    Returns:
+        None
+    """
+    dir = normalize_seafile_dir(dir)
+
+    with known_seafile_dirs_lock:
+        # Subdirectories are gone as well
+        missing = {
+            path
+            for path in known_seafile_dirs
+            if path == dir or path.startswith(dir + "/")
+        }
+        if missing:
+            known_seafile_dirs.difference_update(missing)
+            save_known_seafile_dirs()
 
 
 def check_seafile_upload_dir(seafile_upload_dir):
@@ -179,6 +418,8 @@ def check_seafile_upload_dir(seafile_upload_dir):
     Check if a given directory exists in the Seafile library.
     If it does not exist, create the directory.
 
+    Directories that are known to exist are not checked again.
+
     Args:
         seafile_upload_dir (str): The directory to check for.
 
@@ -186,6 +427,9 @@ def check_seafile_upload_dir(seafile_upload_dir):
         None
     """
 
+    if normalize_seafile_dir(seafile_upload_dir) in known_seafile_dirs:
+        return
+
     response = check_seafile_dir(seafile_upload_dir)
 
     while response.status_code == 404:
@@ -199,7 +443,9 @@ def check_seafile_upload_dir(seafile_upload_dir):
             print("Directory exists: " + seafile_upload_dir)
             break
 
-    if response.status_code != 200:
+    if response.status_code == 200:
+        remember_seafile_dir(seafile_upload_dir)
+    else:
         print("Failed to create directory: " + seafile_upload_dir)
 
 
@@ -221,6 +467,10 @@ def create_seafile_upload_dir(seafile_upload_dir):
     for i in range(1, len(dirs) + 1):
         dir_path = "/" + "/".join(dirs[:i])
 
+        # Skip the directories that are known to exist
+        if dir_path in known_seafile_dirs:
+            continue
+
         response = check_seafile_dir(dir_path)  # Call check_seafile_dir
 
         if response.status_code != 200:
@@ -228,7 +478,9 @@ def create_seafile_upload_dir(seafile_upload_dir):
             data = {"operation": "mkdir"}
             headers = {"Authorization": f"Token {seafile_api_token}"}
             
-            response = requests.post(url, data=data, headers=headers)
+            response = requests.post(
+                url, data=data, headers=headers, timeout=seafile_request_timeout
+            )
             if response.status_code == 201:
                 print("Created directory: " + dir_path)
 
@@ -247,31 +499,338 @@ def get_upload_dir():
     return f"{seafile_dir}/{date_string}"
 
 
-def upload_to_seafile(item_name):
+class MultipartStream:
+    """
+    A multipart/form-data request body that streams the file parts from iterators of chunks.
+
+    Passing this to `requests` sends the body as it is produced, so files of any size are
+    uploaded with constant memory.
     """
-    Upload a file to the Seafile library.
+
+    def __init__(self, fields, files):
+        """
+        Args:
+            fields (dict): The form fields sent before the files.
+            files (list): A list of (file name, chunks, file size) tuples. The chunks are the
+                content of the file as an iterable of bytes, the file size may be None if unknown.
+        """
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+
+        self.head = "".join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+            for name, value in fields.items()
+        ).encode()
+        self.files = [
+            (
+                (
+                    f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{file_name}"\r\n'
+                    "Content-Type: application/octet-stream\r\n\r\n"
+                ).encode(),
+                chunks,
+                file_size,
+            )
+            for file_name, chunks, file_size in files
+        ]
+        self.tail = f"--{boundary}--\r\n".encode()
+
+    def has_length(self):
+        """Check if the size of all files, and so the length of the body, is known."""
+        return all(file_size is not None for _, _, file_size in self.files)
+
+    def __iter__(self):
+        yield self.head
+        for part_head, chunks, _ in self.files:
+            yield part_head
+            for chunk in chunks:
+                if chunk:
+                    yield chunk
+            yield b"\r\n"
+        yield self.tail
+
+    def __len__(self):
+        return (
+            len(self.head)
+            + sum(len(part_head) + file_size + 2 for part_head, _, file_size in self.files)
+            + len(self.tail)
+        )
+
+
+def open_attachment_stream(item_url, offset=0):
+    """
+    Open a streaming download of an attachment stored in SeaTable.
 
     Args:
-        item_url (str): The URL of the file to upload.
-        item_name (str): The name of the file.
+        item_url (str): The URL of the attachment.
+        offset (int, optional): The position in the file to start the download at.
 
     Returns:
-        str: The URL of the uploaded file in the Seafile library.
+        requests.Response: The response with the not yet consumed body.
+
+    Raises:
+        Exception: If the attachment could not be downloaded.
+    """
+    # Same path handling as base.download_file, but without writing to disk
+    path = urllib.parse.unquote(item_url.split(str(base.dtable_uuid))[-1].strip("/"))
+    download_link = base.get_file_download_link(path)
+
+    # Ask for the raw bytes, so Content-Length is the size of the file
+    headers = {"Accept-Encoding": "identity"}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+    response = requests.get(
+        download_link, headers=headers, stream=True, timeout=seafile_request_timeout
+    )
+
+    if response.status_code != (206 if offset else 200):
+        response.close()
+        error = TransferInterrupted if response.status_code >= 500 else Exception
+        raise error(
+            f"Failed to download {item_url}. Status code: {response.status_code}"
+        )
+
+    return response
+
+
+def check_upload_response(response, seafile_upload_dir, url, files):
+    """
+    Check the response of Seafile to an upload request.
+
+    Args:
+        response (requests.Response): The response to the upload request.
+        seafile_upload_dir (str): The directory the files were uploaded to.
+        url (str): The upload link that was used.
+        files (list): The uploaded (file name, chunks, file size) tuples.
+
+    Returns:
+        None
+
+    Raises:
+        SeafileDirNotFound: If the upload directory does not exist (anymore).
+        SeafileUploadLinkExpired: If the cached upload link is no longer valid.
+        TransferInterrupted: If Seafile failed with a 5xx status.
+        Exception: If Seafile does not accept the upload.
+    """
+    if response.status_code == 404:
+        # The cached directory is gone, check it again on the next upload
+        forget_seafile_dir(seafile_upload_dir)
+        raise SeafileDirNotFound(f"Upload directory {seafile_upload_dir} not found")
+
+    if response.status_code in (401, 403):
+        # The upload link has expired, request a new one on the next upload
+        forget_upload_url(seafile_upload_dir, url)
+        raise SeafileUploadLinkExpired(f"Upload link for {seafile_upload_dir} expired")
+
+    if response.status_code != 200:
+        file_names = ", ".join(file_name for file_name, _, _ in files)
+        error = TransferInterrupted if response.status_code >= 500 else Exception
+        raise error(
+            f"Failed to upload {file_names}. Status code: {response.status_code}"
+        )
+
+
+def upload_files_to_seafile(files):
+    """
+    Upload one or more files to the Seafile library with a single request.
+
+    Args:
+        files (list): A list of (file name, chunks, file size) tuples, see MultipartStream.
+            If any file size is unknown, the files are sent with chunked transfer encoding.
+
+    Returns:
+        list: The URLs of the uploaded files in the Seafile library, in the order of the files.
+
+    Raises:
+        SeafileDirNotFound: If the upload directory does not exist (anymore).
+        SeafileUploadLinkExpired: If the cached upload link is no longer valid.
+        Exception: If Seafile does not accept the upload.
     """
 
     seafile_upload_dir = get_upload_dir()
 
     check_seafile_upload_dir(seafile_upload_dir)
 
-    url = get_upload_url(
-        seafile_host, seafile_library_id, seafile_api_token, seafile_upload_dir
+    url = get_cached_upload_url(seafile_upload_dir)
+    body = MultipartStream({"parent_dir": f"/{seafile_upload_dir}"}, files)
+    headers = {
+        "Authorization": f"Token {seafile_api_token}",
+        "Content-Type": body.content_type,
+    }
+    # ret-json makes Seafile return the names the files were stored with
+    response = requests.post(
+        url,
+        headers=headers,
+        params={"ret-json": 1},
+        data=body if body.has_length() else iter(body),
+        timeout=seafile_request_timeout,
     )
+
+    check_upload_response(response, seafile_upload_dir, url, files)
+
+    uploaded = response.json()
+    if len(uploaded) != len(files):
+        file_names = ", ".join(file_name for file_name, _, _ in files)
+        raise Exception(f"Failed to upload {file_names}. Seafile stored {len(uploaded)} file(s)")
+
+    return [
+        f"seafile-connector://{seafile_library_api_token}/{seafile_upload_dir}/{file['name']}"
+        for file in uploaded
+    ]
+
+
+def upload_to_seafile(item_name, chunks, file_size=None):
+    """
+    Upload a file to the Seafile library.
+
+    Args:
+        item_name (str): The name of the file.
+        chunks (iterable): The content of the file as an iterable of bytes.
+        file_size (int, optional): The size of the file. If it is unknown, the
+            file is sent with chunked transfer encoding.
+
+    Returns:
+        str: The URL of the uploaded file in the Seafile library.
+
+    Raises:
+        SeafileDirNotFound: If the upload directory does not exist (anymore).
+        SeafileUploadLinkExpired: If the cached upload link is no longer valid.
+        Exception: If Seafile does not accept the upload.
+    """
+    return upload_files_to_seafile([(item_name, chunks, file_size)])[0]
+
+
+def get_uploaded_bytes(seafile_upload_dir, item_name):
+    """
+    Get the number of bytes of a file that Seafile received in an interrupted chunked upload.
+
+    Args:
+        seafile_upload_dir (str): The directory the file is uploaded to.
+        item_name (str): The name of the file.
+
+    Returns:
+        int: The number of bytes that were received.
+    """
+    url = f"{seafile_host}/api/v2.1/repos/{seafile_library_id}/file-uploaded-bytes/"
     headers = {"Authorization": f"Token {seafile_api_token}"}
-    files = {"file": open(item_name, "rb")}
-    data = {"parent_dir": f"/{seafile_upload_dir}"}
-    requests.post(url, headers=headers, files=files, data=data)
+    params = {"parent_dir": f"/{seafile_upload_dir}", "file_name": item_name}
+    response = requests.get(
+        url, headers=headers, params=params, timeout=seafile_request_timeout
+    )
+
+    if response.status_code != 200:
+        error = TransferInterrupted if response.status_code >= 500 else Exception
+        raise error(
+            f"Failed to get the uploaded bytes of {item_name}. Status code: {response.status_code}"
+        )
+
+    return response.json()["uploadedBytes"]
 
-    return f"seafile-connector://{seafile_library_api_token}/{seafile_upload_dir}/{item_name}"
+
+def read_blocks(chunks, block_size):
+    """
+    Regroup an iterable of chunks into blocks of a fixed size.
+
+    Args:
+        chunks (iterable): The content as an iterable of bytes.
+        block_size (int): The size of the blocks. The last block may be smaller.
+
+    Yields:
+        bytes: The blocks.
+    """
+    block = bytearray()
+    for chunk in chunks:
+        block += chunk
+        while len(block) >= block_size:
+            yield bytes(block[:block_size])
+            del block[:block_size]
+    if block:
+        yield bytes(block)
+
+
+def upload_resumable(item_name, open_content, file_size):
+    """
+    Upload a large file to the Seafile library in chunks, resuming after failures.
+
+    Each chunk of `upload_chunk_size` bytes is sent as its own request with a Content-Range
+    header, so at most one chunk is held in memory. After a failure, Seafile is asked how many
+    bytes it received, and the upload continues from there with a new download. If it received
+    the whole file already, nothing is downloaded again. Connection errors, timeouts, 5xx
+    responses and downloads that end early are resumed, up to `upload_retries` times in total,
+    including failures to ask Seafile for the received bytes.
+
+    Args:
+        item_name (str): The name of the file.
+        open_content (callable): Returns a context manager providing the content from a given
+            offset, see streamed_content.
+        file_size (int): The size of the file.
+
+    Returns:
+        str: The URL of the uploaded file in the Seafile library.
+
+    Raises:
+        Exception: If the upload failed more than `upload_retries` times.
+    """
+    seafile_upload_dir = get_upload_dir()
+    offset = 0
+    failures = 0
+
+    resume_error = None
+
+    while True:
+        try:
+            if resume_error:
+                offset = get_uploaded_bytes(seafile_upload_dir, item_name)
+                print(f"Resuming upload of {item_name} at byte {offset}/{file_size} after: {resume_error}")
+
+            # Seafile received every byte, only the response to the last chunk was lost.
+            # The random file name is not taken, so the file was stored under it.
+            if offset >= file_size:
+                return f"seafile-connector://{seafile_library_api_token}/{seafile_upload_dir}/{item_name}"
+
+            check_seafile_upload_dir(seafile_upload_dir)
+            url = get_cached_upload_url(seafile_upload_dir)
+
+            with open_content(offset) as (chunks, _):
+                for block in read_blocks(chunks, upload_chunk_size):
+                    files = [(item_name, [block], len(block))]
+                    body = MultipartStream({"parent_dir": f"/{seafile_upload_dir}"}, files)
+                    headers = {
+                        "Authorization": f"Token {seafile_api_token}",
+                        "Content-Type": body.content_type,
+                        "Content-Disposition": f'attachment; filename="{item_name}"',
+                        "Content-Range": f"bytes {offset}-{offset + len(block) - 1}/{file_size}",
+                    }
+                    response = requests.post(
+                        url,
+                        headers=headers,
+                        params={"ret-json": 1},
+                        data=body,
+                        timeout=seafile_request_timeout,
+                    )
+                    check_upload_response(response, seafile_upload_dir, url, files)
+                    offset += len(block)
+
+            if offset < file_size:
+                raise TransferInterrupted(
+                    f"Failed to upload {item_name}. The download ended at byte {offset}/{file_size}"
+                )
+
+            # The response to the last chunk describes the stored file
+            stored_name = response.json()[0]["name"]
+            return f"seafile-connector://{seafile_library_api_token}/{seafile_upload_dir}/{stored_name}"
+        except (
+            requests.RequestException,
+            SeafileDirNotFound,
+            SeafileUploadLinkExpired,
+            TransferInterrupted,
+        ) as e:
+            failures += 1
+            if failures > upload_retries:
+                raise
+
+            # Give a failing server or proxy some time before resuming
+            resume_error = e
+            time.sleep(min(2 ** failures, 60))
 
 
 def generate_random_filename(length):
@@ -280,74 +839,746 @@ def generate_random_filename(length):
     return random_filename
 
 
-def copy_attachments(column_data):
+def open_dedup_index(dedup_index_file):
+    """
+    Open the SQLite index that maps file contents to the files uploaded to Seafile.
+
+    The index has two tables: 'contents' maps the SHA-256 of a file to its Seafile URL
+    per library, and 'sources' maps SeaTable attachment URLs to the SHA-256 of their content,
+    so an attachment that was seen before does not even have to be downloaded again.
+
+    Args:
+        dedup_index_file (str): The path of the SQLite file.
+
+    Returns:
+        sqlite3.Connection: The connection to the index, shared by all workers.
+    """
+    connection = sqlite3.connect(dedup_index_file, check_same_thread=False)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS contents "
+        "(library_id TEXT, sha256 TEXT, url TEXT, size INTEGER, PRIMARY KEY (library_id, sha256))"
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS sources (source_url TEXT PRIMARY KEY, sha256 TEXT)"
+    )
+    connection.commit()
+
+    return connection
+
+
+def find_deduplicated_url(sha256=None, source_url=None):
     """
-    Copy attachments from Seatable to Seafile and update the URLs in the column data.
+    Look up the Seafile URL of a file that was uploaded before.
+
+    Args:
+        sha256 (str, optional): The SHA-256 of the file content.
+        source_url (str, optional): The SeaTable URL of the attachment.
+
+    Returns:
+        str: The Seafile URL, or None if the content was not uploaded to this library yet.
+    """
+    with dedup_index_lock:
+        if sha256 is None:
+            found = dedup_index.execute(
+                "SELECT sha256 FROM sources WHERE source_url = ?", (source_url,)
+            ).fetchone()
+            if not found:
+                return None
+            sha256 = found[0]
+
+        found = dedup_index.execute(
+            "SELECT url FROM contents WHERE library_id = ? AND sha256 = ?",
+            (seafile_library_id, sha256),
+        ).fetchone()
+
+    return found[0] if found else None
+
+
+def add_deduplicated_url(sha256, source_url, url, size):
+    """
+    Record an uploaded file in the dedup index.
+
+    Args:
+        sha256 (str): The SHA-256 of the file content.
+        source_url (str): The SeaTable URL of the attachment.
+        url (str): The Seafile URL of the uploaded file.
+        size (int): The size of the file in bytes.
+
+    Returns:
+        None
+    """
+    with dedup_index_lock:
+        # Keep the first upload if the same content was uploaded concurrently
+        dedup_index.execute(
+            "INSERT OR IGNORE INTO contents VALUES (?, ?, ?, ?)",
+            (seafile_library_id, sha256, url, size),
+        )
+        dedup_index.execute(
+            "INSERT OR REPLACE INTO sources VALUES (?, ?)", (source_url, sha256)
+        )
+        dedup_index.commit()
+
+
+@contextmanager
+def streamed_content(item_url, offset=0):
+    """
+    Provide the content of an attachment as a download stream.
+
+    Args:
+        item_url (str): The URL of the attachment.
+        offset (int, optional): The position in the file to start at.
+
+    Yields:
+        tuple: The content as an iterable of bytes, and its size from the offset
+            or None if it is unknown.
+    """
+    with open_attachment_stream(item_url, offset) as download:
+        file_size = download.headers.get("Content-Length")
+        yield download.iter_content(stream_chunk_size), int(file_size) if file_size else None
+
+
+@contextmanager
+def spooled_content(spool, file_size, offset=0):
+    """
+    Provide the content of a spooled attachment.
+
+    Args:
+        spool (file): The spooled content.
+        file_size (int): The size of the content.
+        offset (int, optional): The position in the content to start at.
+
+    Yields:
+        tuple: The content as an iterable of bytes, and its size from the offset.
+    """
+    spool.seek(offset)
+    yield iter(lambda: spool.read(stream_chunk_size), b""), file_size - offset
+
+
+def upload_content(item_name, open_content, file_size=None):
+    """
+    Upload the content of an attachment to Seafile, retrying once if the upload directory
+    or the upload link turned out to be stale.
+
+    Files of at least `seafile_chunked_upload_size` bytes are uploaded in resumable chunks.
+
+    Args:
+        item_name (str): The name of the file in Seafile.
+        open_content (callable): Returns a context manager providing the content from a given
+            offset, see streamed_content. It is called again for a retry, as the upload consumes it.
+        file_size (int, optional): The expected size of the file, if known.
+
+    Returns:
+        str: The URL of the uploaded file in the Seafile library.
+    """
+    if seafile_chunked_upload_size and (file_size or 0) >= seafile_chunked_upload_size:
+        return upload_resumable(item_name, open_content, file_size)
+
+    for attempt in range(2):
+        with open_content(0) as (chunks, file_size):
+            try:
+                return upload_to_seafile(item_name, chunks, file_size)
+            except (SeafileDirNotFound, SeafileUploadLinkExpired):
+                # Retry once, upload_to_seafile creates the directory or
+                # requests a new upload link
+                if attempt:
+                    raise
+
+
+def copy_attachment_deduplicated(item, new_item_name):
+    """
+    Copy a single attachment from Seatable to Seafile, unless its content was uploaded before.
+
+    The download is spooled (in memory up to `spool_memory_size`, on disk beyond) while it
+    is hashed, so the upload can be skipped for known content. The spool is removed afterwards.
+
+    Args:
+        item (dict): The attachment as stored in the 'file' column.
+        new_item_name (str): The name of the file in Seafile.
+
+    Returns:
+        str: The URL of the uploaded or the already existing file in the Seafile library.
+    """
+    # Attachments seen before do not have to be downloaded again
+    url = find_deduplicated_url(source_url=item["url"])
+    if url:
+        return url
+
+    with tempfile.SpooledTemporaryFile(max_size=spool_memory_size) as spool:
+        sha256 = hashlib.sha256()
+        file_size = 0
+        with streamed_content(item["url"]) as (chunks, _):
+            for chunk in chunks:
+                sha256.update(chunk)
+                spool.write(chunk)
+                file_size += len(chunk)
+        sha256 = sha256.hexdigest()
+
+        url = find_deduplicated_url(sha256=sha256)
+        if not url:
+            url = upload_content(
+                new_item_name,
+                lambda offset: spooled_content(spool, file_size, offset),
+                file_size,
+            )
+
+    add_deduplicated_url(sha256, item["url"], url, file_size)
+
+    return url
+
+
+def load_migration_journal():
+    """
+    Load the attachments copied and the table checkpoints reached in earlier runs.
+
+    The journal is a JSON lines file, only used if the 'migration_journal_file' setting is set.
+    Each line records either a copied attachment ({"source_url": ..., "url": ...}) or a
+    checkpoint of a table run ({"table": ..., "view": ..., "start": ...}). Later lines win.
+
+    Returns:
+        None
+    """
+    if not migration_journal_file or not os.path.exists(migration_journal_file):
+        return
+
+    with open(migration_journal_file) as journal:
+        for line in journal:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line may be incomplete if the run died while writing it
+                continue
+            if "source_url" in entry:
+                journaled_urls[entry["source_url"]] = entry["url"]
+            elif "start" in entry:
+                journaled_checkpoints[(entry["table"], entry["view"])] = entry["start"]
+
+
+def write_migration_journal(entry):
+    """
+    Append an entry to the migration journal and flush it to disk.
+
+    Args:
+        entry (dict): The entry, see load_migration_journal.
+
+    Returns:
+        None
+    """
+    if not migration_journal_file:
+        return
+
+    with migration_journal_lock:
+        with open(migration_journal_file, "a") as journal:
+            journal.write(json.dumps(entry) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+
+def is_migrated(item):
+    """
+    Check if an attachment already points to Seafile.
+
+    Args:
+        item (dict): The attachment as stored in the 'file' column.
+
+    Returns:
+        bool: True if the attachment was migrated before.
+    """
+    return str(item.get("url", "")).startswith("seafile-connector://")
+
+
+def get_asset_path(item_url):
+    """
+    Get the path of a SeaTable attachment in the Seafile library that stores the assets of the base.
+
+    Args:
+        item_url (str): The URL of the attachment, e.g.
+            https://seatable.example.com/workspace/1/asset/<dtable uuid>/files/2023-05/a.pdf
+
+    Returns:
+        str: The path of the attachment, e.g. /asset/<dtable uuid>/files/2023-05/a.pdf
+    """
+    asset_path = urllib.parse.urlparse(item_url).path.split("/asset/", 1)[1]
+
+    return "/asset/" + urllib.parse.unquote(asset_path)
+
+
+def copy_attachment_server_side(item, new_item_name):
+    """
+    Let Seafile copy an attachment from the SeaTable asset library into the Seafile library.
+
+    No data passes through the script. The copy is renamed to the new name afterwards,
+    like the uploaded attachments. If the rename fails, the copy is deleted again.
+
+    Args:
+        item (dict): The attachment as stored in the 'file' column.
+        new_item_name (str): The name of the file in Seafile.
+
+    Returns:
+        str: The URL of the copied file in the Seafile library.
+
+    Raises:
+        Exception: If Seafile could not copy or rename the file.
+    """
+    seafile_upload_dir = get_upload_dir()
+    check_seafile_upload_dir(seafile_upload_dir)
+
+    headers = {"Authorization": f"Token {seafile_api_token}"}
+
+    url = f"{seafile_host}/api/v2.1/repos/{seatable_asset_repo_id}/file/"
+    params = {"p": get_asset_path(item["url"])}
+    data = {
+        "operation": "copy",
+        "dst_repo": seafile_library_id,
+        "dst_dir": f"/{seafile_upload_dir}",
+    }
+    response = requests.post(
+        url, headers=headers, params=params, data=data, timeout=seafile_request_timeout
+    )
+    if response.status_code != 200:
+        raise Exception(
+            f"Failed to copy {item['name']}. Status code: {response.status_code}"
+        )
+    copied = response.json()
+
+    url = f"{seafile_host}/api/v2.1/repos/{seafile_library_id}/file/"
+    params = {"p": f"{copied['parent_dir'].rstrip('/')}/{copied['obj_name']}"}
+    data = {"operation": "rename", "newname": new_item_name}
+    response = requests.post(
+        url, headers=headers, params=params, data=data, timeout=seafile_request_timeout
+    )
+    if response.status_code != 200:
+        # Delete the copy, the fallback uploads the attachment again
+        delete_response = requests.delete(
+            url, headers=headers, params=params, timeout=seafile_request_timeout
+        )
+        if delete_response.status_code != 200:
+            print(
+                f"Failed to delete the copy {params['p']}. Status code: {delete_response.status_code}"
+            )
+        raise Exception(
+            f"Failed to rename the copy of {item['name']}. Status code: {response.status_code}"
+        )
+    renamed = response.json()
+
+    return f"seafile-connector://{seafile_library_api_token}/{seafile_upload_dir}/{renamed['obj_name']}"
+
+
+def copy_attachment(item):
+    """
+    Copy a single attachment from Seatable to Seafile.
+
+    Attachments that were copied by an earlier, interrupted run are not copied again.
+    If possible, Seafile copies the attachment itself, otherwise it is downloaded and uploaded.
+
+    Args:
+        item (dict): The attachment as stored in the 'file' column.
+
+    Returns:
+        str: The URL of the uploaded file in the Seafile library.
+    """
+    source_url = item["url"]
+    if source_url in journaled_urls:
+        return journaled_urls[source_url]
+
+    filename, filename_suffix = os.path.splitext(item["name"])
+    new_item_name = generate_random_filename(8) + filename_suffix
+
+    url = None
+    if seatable_asset_repo_id:
+        try:
+            url = copy_attachment_server_side(item, new_item_name)
+        except Exception as e:
+            print(f"Falling back to download and upload for {item['name']}: {e}")
+
+    if not url and dedup_index:
+        url = copy_attachment_deduplicated(item, new_item_name)
+    elif not url:
+        # Pipe the download into the upload, chunk by chunk
+        url = upload_content(
+            new_item_name,
+            lambda offset: streamed_content(source_url, offset),
+            item.get("size"),
+        )
+
+    write_migration_journal({"source_url": source_url, "url": url})
+
+    return url
+
+
+def streamed_chunks(item_url):
+    """
+    Stream the content of an attachment, opening the download only when it is iterated.
+
+    Args:
+        item_url (str): The URL of the attachment.
+
+    Yields:
+        bytes: The chunks of the content.
+    """
+    with streamed_content(item_url) as (chunks, _):
+        yield from chunks
+
+
+def copy_attachment_batch(batch):
+    """
+    Copy several small attachments from Seatable to Seafile with a single upload request.
+
+    The downloads are opened one after the other while the request body is sent. If the
+    batch fails, its attachments are copied one by one, so only the broken ones fail.
+    Any other error is set on the futures that are still pending, so no caller waits forever.
+
+    Args:
+        batch (list): A list of (attachment, future) tuples. The futures receive the URLs.
+
+    Returns:
+        None
+    """
+    try:
+        new_item_names = [
+            generate_random_filename(8) + os.path.splitext(item["name"])[1]
+            for item, _ in batch
+        ]
+
+        try:
+            for attempt in range(2):
+                files = [
+                    (new_item_name, streamed_chunks(item["url"]), None)
+                    for new_item_name, (item, _) in zip(new_item_names, batch)
+                ]
+                try:
+                    urls = upload_files_to_seafile(files)
+                    break
+                except (SeafileDirNotFound, SeafileUploadLinkExpired):
+                    # Retry once, upload_files_to_seafile creates the directory or
+                    # requests a new upload link
+                    if attempt:
+                        raise
+        except Exception as e:
+            print(f"Failed to upload a batch of {len(batch)} attachments, copying them one by one: {e}")
+            for item, future in batch:
+                try:
+                    future.set_result(copy_attachment(item))
+                except Exception as item_error:
+                    future.set_exception(item_error)
+            return
+
+        for (item, future), url in zip(batch, urls):
+            write_migration_journal({"source_url": item["url"], "url": url})
+            future.set_result(url)
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+
+
+def is_batchable(item):
+    """
+    Check if an attachment is small enough to be uploaded in a batch with others.
+
+    Args:
+        item (dict): The attachment as stored in the 'file' column.
+
+    Returns:
+        bool: True if the attachment should be uploaded in a batch.
+    """
+    if not seafile_upload_batch_size or dedup_index or seatable_asset_repo_id:
+        return False
+
+    if item["url"] in journaled_urls:
+        return False
+
+    return 0 < (item.get("size") or 0) <= seafile_upload_batch_size
+
+
+def submit_attachment_batches(batchable, executor):
+    """
+    Group small attachments into size-capped batches and start uploading them.
+
+    Args:
+        batchable (list): A list of (attachment, future) tuples, see submit_attachments.
+        executor (ThreadPoolExecutor): The pool that copies the attachments.
+
+    Returns:
+        None
+    """
+    batch = []
+    batch_size = 0
+    for item, future in batchable:
+        if batch and (
+            batch_size + item["size"] > seafile_upload_batch_size
+            or len(batch) >= seafile_upload_batch_files
+        ):
+            executor.submit(copy_attachment_batch, batch)
+            batch = []
+            batch_size = 0
+        batch.append((item, future))
+        batch_size += item["size"]
+
+    if batch:
+        executor.submit(copy_attachment_batch, batch)
+
+
+def submit_attachments(column_data, executor, batchable):
+    """
+    Start copying attachments from Seatable to Seafile.
 
     Args:
         column_data (list): A list of dictionaries representing the attachments column data.
+        executor (ThreadPoolExecutor): The pool that copies the attachments.
+        batchable (list): Small attachments are not submitted, but added to this list as
+            (attachment, future) tuples to be uploaded in batches by submit_attachment_batches.
 
     Returns:
-        list: A list of updated dictionaries representing the attachments column data with updated URLs.
+        list: A list of (attachment, future) tuples in the original order of the attachments.
+            The future is None for attachments that already point to Seafile.
     """
+    if not isinstance(column_data, list):
+        return []
+
+    copies = []
+    for item in column_data:
+        if is_migrated(item):
+            future = None
+        elif is_batchable(item):
+            future = Future()
+            batchable.append((item, future))
+        else:
+            future = executor.submit(copy_attachment, item)
+        copies.append((item, future))
+
+    return copies
+
+
+def collect_attachments(copies):
+    """
+    Wait for copied attachments and update the URLs in the column data.
+
+    An attachment that failed to copy keeps its original URL, so the other attachments are not lost.
+
+    Args:
+        copies (list): The (attachment, future) tuples returned by submit_attachments.
 
+    Returns:
+        tuple: A list of updated dictionaries representing the attachments column data with
+            updated URLs, the number of attachments that were copied, and a list of
+            (file name, error) tuples for the failed attachments.
+    """
     updated_data = []
-    if isinstance(column_data, list):
-        for item in column_data:
-            item_url = item["url"]
-            item_name = item["name"]
+    copied = 0
+    failures = []
 
-            base.download_file(item_url, item_name)
+    # Collect the results in the original order of the attachments
+    for item, future in copies:
+        if future is not None:
+            try:
+                item["url"] = future.result()
+                copied += 1
+            except Exception as e:
+                print(f"Failed to copy {item['name']}: {e}")
+                failures.append((item["name"], e))
+        updated_data.append(item)
 
-            filename, filename_suffix = os.path.splitext(item_name)
-            new_item_name = generate_random_filename(8) + filename_suffix
-            
-            os.rename(item_name, new_item_name)
-            
-            new_url = upload_to_seafile(new_item_name)
-            item["url"] = new_url
-            updated_data.append(item)
+    return updated_data, copied, failures
+
+
+def migrate_rows(rows, file_columns, executor):
+    """
+    Copy the attachments of the 'file' columns of several rows.
+
+    The attachments of all rows are submitted to the pool at once, so up to
+    `seafile_concurrency` attachments are copied at the same time, across rows.
 
-    return updated_data
+    Args:
+        rows (list): The rows to migrate.
+        file_columns (list): The names of the 'file' columns.
+        executor (ThreadPoolExecutor): The pool that copies the attachments.
+
+    Returns:
+        list: A list of (row, row data, copied, failures) tuples. The row data maps the
+            'file' columns with copied attachments to their updated column data, copied
+            is the number of attachments that were copied.
+    """
+    # Create the upload directory once, before the workers race to create it
+    check_seafile_upload_dir(get_upload_dir())
+
+    submitted = []
+    batchable = []
+    for row in rows:
+        column_copies = {
+            column_name: submit_attachments(row.get(column_name), executor, batchable)
+            for column_name in file_columns
+        }
+        submitted.append((row, column_copies))
+
+    # Small attachments of all rows are uploaded together
+    submit_attachment_batches(batchable, executor)
+
+    results = []
+    for row, column_copies in submitted:
+        row_data = {}
+        copied = 0
+        failures = []
+        for column_name, copies in column_copies.items():
+            updated_data, column_copied, column_failures = collect_attachments(copies)
+
+            # Columns without copied attachments do not have to be written
+            if column_copied:
+                row_data[column_name] = updated_data
+                copied += column_copied
+            failures.extend(column_failures)
+        results.append((row, row_data, copied, failures))
+
+    return results
+
+
+def get_file_columns(table_name):
+    """
+    Get the names of the 'file' columns of a table.
+
+    Args:
+        table_name (str): The name of the table.
+
+    Returns:
+        list: The names of the 'file' columns.
+    """
+    columns = base.list_columns(table_name)
+
+    return [item.get("name") for item in columns if item.get("type") == "file"]
 
 
 check_config_table(config_table)
 config_values = get_config_values(config_table)
 locals().update(config_values)
 
+# Optional settings, settings tables created by older versions do not have them
+seafile_concurrency = int(config_values.get("seafile_concurrency", 1))
+seafile_dir_cache_file = config_values.get("seafile_dir_cache_file")
+seafile_upload_link_ttl = int(config_values.get("seafile_upload_link_ttl", 300))
+migration_mode = config_values.get("migration_mode", "row")
+migration_table = config_values.get("migration_table", table_name)
+migration_view = config_values.get("migration_view")
+dedup_index_file = config_values.get("dedup_index_file")
+migration_journal_file = config_values.get("migration_journal_file")
+seafile_upload_batch_size = int(config_values.get("seafile_upload_batch_size", 0))
+seafile_upload_batch_files = int(config_values.get("seafile_upload_batch_files", 20))
+seafile_chunked_upload_size = int(config_values.get("seafile_chunked_upload_size", 0))
+seatable_asset_repo_id = config_values.get("seatable_asset_repo_id")
+seafile_request_timeout = int(config_values.get("seafile_request_timeout", 60))
+
+if dedup_index_file:
+    dedup_index = open_dedup_index(dedup_index_file)
+
+load_known_seafile_dirs()
+load_migration_journal()
+
+
+def migrate_table(migration_table, migration_view=None):
+    """
+    Copy the attachments of all rows of a table or view to Seafile and update the rows with the new URLs.
+
+    The rows are read page by page and written back with batch updates. With a migration
+    journal, a checkpoint is written after each page and an interrupted run resumes from it.
+
+    Args:
+        migration_table (str): The name of the table.
+        migration_view (str, optional): The name of a view that limits the rows.
+
+    Raises:
+        ValueError: If the table has no 'file' columns.
+        Exception: If any attachment could not be copied. The rows are still updated
+            with the URLs of the attachments that were copied.
+    """
+    file_columns = get_file_columns(migration_table)
+    if not file_columns:
+        raise ValueError(f"No 'file' columns found in table {migration_table}")
+
+    start = journaled_checkpoints.get((migration_table, migration_view), 0)
+    if start:
+        print(f"Resuming from row {start}")
+
+    processed_rows = 0
+    migrated_rows = 0
+    migrated_files = 0
+    failures = []
+    started_at = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=max(1, seafile_concurrency)) as executor:
+        while True:
+            rows = base.list_rows(
+                migration_table,
+                view_name=migration_view,
+                start=start,
+                limit=rows_page_size,
+            )
+            if not rows:
+                break
+
+            updates = []
+            for row, row_data, copied, row_failures in migrate_rows(rows, file_columns, executor):
+                if row_data:
+                    updates.append({"row_id": row["_id"], "row": row_data})
+                migrated_files += copied
+                failures.extend(row_failures)
+
+            # Write back the new URLs in chunks the API accepts
+            for i in range(0, len(updates), batch_update_size):
+                base.batch_update_rows(migration_table, updates[i:i + batch_update_size])
+
+            start += len(rows)
+            processed_rows += len(rows)
+            migrated_rows += len(updates)
+            write_migration_journal(
+                {"table": migration_table, "view": migration_view, "start": start}
+            )
+            elapsed = max(time.monotonic() - started_at, 0.001)
+            print(
+                f"Processed {start} rows: {migrated_rows} rows and {migrated_files} files migrated, "
+                f"{len(failures)} failed ({processed_rows / elapsed:.1f} rows/s, {migrated_files / elapsed:.1f} files/s)"
+            )
+
+            if len(rows) < rows_page_size:
+                break
+
+    # The run is complete, the next run starts from the first row again
+    write_migration_journal({"table": migration_table, "view": migration_view, "start": 0})
+
+    if failures:
+        failed_names = ", ".join(name for name, _ in failures)
+        raise Exception(f"Failed to copy {len(failures)} attachment(s): {failed_names}")
+
 
 def main():
     """Copy attachments from the 'file' columns of a SeaTable row, upload them to Seafile, and update the row data with the new URLs.
 
     Raises:
         ValueError: If the SeaTable row or any of its 'file' columns are not found.
+        Exception: If any attachment could not be copied. The row is still updated
+            with the URLs of the attachments that were copied.
     """
     # Get the current row data from SeaTable
     row = context.current_row
     if not row:
         raise ValueError("Row not found")
 
-    # Iterate through the 'file' columns and copy the attachments
-    updated_row_data = []
-    columns = base.list_columns(table_name)
-    for item in columns:
-        if item.get("type") == "file":
-            item.get("key")
-            column_name = item.get("name")
-            column_data = row.get(column_name)
-            updated_data = copy_attachments(column_data)
+    file_columns = get_file_columns(table_name)
+    if not file_columns:
+        raise ValueError("No 'file' columns found in the row")
 
-            # Update the row data with the new URLs
-            row_data = {column_name: updated_data}
-            updated_row_data.append(row_data)
+    # Copy the attachments of all 'file' columns
+    with ThreadPoolExecutor(max_workers=max(1, seafile_concurrency)) as executor:
+        [(row, row_data, copied, failures)] = migrate_rows([row], file_columns, executor)
 
     # Update the row in SeaTable with the new URLs
-    if updated_row_data:
-        for row_data in updated_row_data:
-            base.update_row(table_name, row["_id"], row_data)
-    else:
-        raise ValueError("No 'file' columns found in the row")
+    if row_data:
+        base.update_row(table_name, row["_id"], row_data)
+
+    if failures:
+        failed_names = ", ".join(name for name, _ in failures)
+        raise Exception(f"Failed to copy {len(failures)} attachment(s): {failed_names}")
 
 
 if __name__ == "__main__":
-    main()
+    if migration_mode == "table":
+        migrate_table(migration_table, migration_view)
+    else:
+        main()